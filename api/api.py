@@ -1,5 +1,6 @@
 from app import app, db
-from app.models import Account, AddedTrack, Match, Plex, Scrobble
+from app.models import (Account, AddedTrack, Generation, LastfmTrack, Match, MatchPlay, MatchProposal, Plex,
+                        PlexWrite, Scrobble, Suggestion)
 
 @app.shell_context_processor
 def make_shell_context():
@@ -7,7 +8,32 @@ def make_shell_context():
         'db': db,
         'Account': Account,
         'AddedTrack': AddedTrack,
+        'Generation': Generation,
+        'LastfmTrack': LastfmTrack,
         'Match': Match,
+        'MatchPlay': MatchPlay,
+        'MatchProposal': MatchProposal,
         'Plex': Plex,
-        'Scrobble': Scrobble
-    }
\ No newline at end of file
+        'PlexWrite': PlexWrite,
+        'Scrobble': Scrobble,
+        'Suggestion': Suggestion
+    }
+
+@app.cli.command('rehash-scrobbles')
+def rehash_scrobbles_command():
+    """Replace md5 scrobble hashes with 64-bit integer fingerprints."""
+    from app.functions import rehash_scrobbles
+    print(f'Rehashed {rehash_scrobbles()} scrobbles')
+
+@app.cli.command('normalize-scrobbles')
+def normalize_scrobbles_command():
+    """Move Last.fm artist/album/track data out of scrobbles into the lastfm_tracks table."""
+    from app.functions import normalize_scrobbles
+    print(f'Normalized {normalize_scrobbles()} scrobbles')
+
+@app.cli.command('rebuild-match-plays')
+def rebuild_match_plays_command():
+    """Recount the per-day plays of every match from the scrobbles table."""
+    from app.functions import bump_generations, rebuild_match_plays
+    print(f'Rebuilt {rebuild_match_plays()} daily play counts')
+    bump_generations('matches')
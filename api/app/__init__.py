@@ -6,10 +6,18 @@ from flask_sqlalchemy import SQLAlchemy
 
 app = Flask(__name__, static_folder="../../dist", static_url_path="/")
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'app.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['LASTFM_API_URL'] = os.environ.get('LASTFM_API_URL') or 'http://ws.audioscrobbler.com/2.0/'
 db = SQLAlchemy(app)
 ma = Marshmallow(app)
-migrate = Migrate(app, db, render_as_batch=True)
+
+
+def include_name(name, type_, parent_names):
+    # The FTS5 search indexes, their shadow tables and triggers are managed by functions.ensure_search_index
+    return not (type_ == 'table' and (name.endswith('_fts') or '_fts_' in name))
+
+
+migrate = Migrate(app, db, render_as_batch=True, include_name=include_name)
 
 from app import routes, models, functions
\ No newline at end of file
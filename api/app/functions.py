@@ -1,40 +1,45 @@
-import hashlib
+import base64
+import json
+import multiprocessing
 import numpy as np
 import pandas as pd
 import requests
+import secrets
 import sqlite3
+import threading
 import time
-from app import db
-from app.models import Account, AddedTrack, Match, Plex, Scrobble
-from sqlalchemy import func, select
-
-
-cols_filter = [
-    'id_track',
-    'title_track',
-    'original_title_track',
-    'index_track',
-    'guid_track',
-    'title_album',
-    'index_album',
-    'guid_album',
-    'title',
-    'guid',
-    'file'
-]
+from app import app, db
+from app.models import (Account, AddedTrack, Generation, LastfmTrack, Match, MatchPlay, MatchProposal, Plex,
+                        PlexWrite, Scrobble, Suggestion)
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime
+from fuzzywuzzy import fuzz, process, utils
+from itertools import islice
+from requests.adapters import HTTPAdapter
+from sqlalchemy import (asc, bindparam, case, desc, func, insert, literal_column, null, or_, select, tuple_,
+                        union_all)
+from sqlalchemy import column as sqlalchemy_column
+from sqlalchemy import inspect as sqlalchemy_inspect
+from sqlalchemy import table as sqlalchemy_table
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.schema import CreateTable
+from urllib3.util import Retry
+
 
-rename = {
-    'id_track': 'rating_key',
-    'title_track': 'track',
-    'original_title_track': 'artist_feat',
-    'index_track': 'track_index',
-    'guid_track': 'guid',
-    'title_album': 'album',
-    'index_album': 'parent_index',
-    'guid_album': 'parent_guid',
-    'title': 'artist',
-    'guid': 'grandparent_guid'
-}
+SUGGESTION_LIMIT = 5
+SUGGESTION_CUTOFF = 60
+SUGGESTION_LOW_WATER = 50
+AUTO_RESOLVE_THRESHOLD = 95
+PROPOSAL_LIMIT = 3
+PROPOSAL_THRESHOLD = 85
+LASTFM_RATE_LIMIT = 5
+LASTFM_WORKERS = 4
+LASTFM_SYNC_OVERLAP = 86400
+CSV_CHUNK_SIZE = 50000
+MATCH_PAGE_SIZE = 20
+PLEX_FINGERPRINT_COLUMNS = ['guid', 'track', 'artist_feat', 'track_index', 'album', 'parent_guid', 'parent_index',
+                            'artist', 'grandparent_guid']
 
 
 """
@@ -42,86 +47,92 @@ rename = {
 """
 
 
-def create_settings_row(guid, created_at, updated_at):
-    insert_sql = '''INSERT INTO metadata_item_settings (account_id, guid, created_at, updated_at) VALUES (?, ?, ?, ?)'''
+def add_scrobbles_to_plex(incremental=False):
+    insert_views = '''INSERT INTO metadata_item_views (account_id, guid, metadata_type, library_section_id,
+                         grandparent_title, parent_index, parent_title, "index", title, viewed_at, grandparent_guid,
+                         device_id)
+                     VALUES (?, ?, 10, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+    select_settings_guids = '''SELECT guid FROM metadata_item_settings WHERE account_id=? AND guid IN ({})'''
+    insert_settings = '''INSERT INTO metadata_item_settings (account_id, guid, created_at, updated_at) VALUES (?, ?, ?, ?)'''
+    update_settings = '''UPDATE metadata_item_settings SET last_viewed_at=?, view_count=? WHERE account_id=? AND guid=?'''
+    update_settings_delta = '''UPDATE metadata_item_settings
+                               SET last_viewed_at=MAX(COALESCE(last_viewed_at, 0), ?),
+                                   view_count=COALESCE(view_count, 0)+?
+                               WHERE account_id=? AND guid=?'''
     account = db.session.query(Account).first()
-    with sqlite3.connect(account.plex_db_file) as conn:
-        c = conn.cursor()
-        c.execute(insert_sql, [account.plex_account_id, guid, created_at, updated_at])
-        conn.commit()
-    return
-
+    views = (db.session.query(Scrobble.id, Plex.guid, Plex.artist, Plex.parent_index, Plex.album, Plex.track_index,
+                              Plex.track, Scrobble.played_at, Plex.grandparent_guid, Plex.parent_guid)
+             .join(LastfmTrack, Scrobble.track_id == LastfmTrack.id)
+             .join(Match, LastfmTrack.match_id == Match.id)
+             .join(Plex, Match.plex_id == Plex.id)
+             .filter(Scrobble.status == 'matched')
+             .order_by(Scrobble.id)
+             .all())
+    if len(views) == 0:
+        account.last_plex_update = datetime.utcnow()
+        db.session.commit()
+        return
+    all_info = []
+    if incremental:
+        # Only the newly matched plays are counted; view_count is moved by that delta
+        views_df = pd.DataFrame.from_records(views, columns=['id', 'guid', 'artist', 'parent_index', 'album',
+                                                             'track_index', 'track', 'played_at',
+                                                             'grandparent_guid', 'parent_guid'])
+        for column in ['guid', 'parent_guid', 'grandparent_guid']:
+            grouped = views_df.groupby(column)['played_at'].agg(['count', 'max'])
+            all_info += [(guid, int(count), int(viewed_at)) for (guid, count, viewed_at) in grouped.itertuples()]
+    else:
+        touched_ids = (select(Match.plex_id)
+                       .join(LastfmTrack, Match.id == LastfmTrack.match_id)
+                       .join(Scrobble, LastfmTrack.id == Scrobble.track_id)
+                       .where(Scrobble.status == 'matched'))
+        for column in [Plex.guid, Plex.parent_guid, Plex.grandparent_guid]:
+            touched_guids = select(column).where(Plex.id.in_(touched_ids))
+            all_info += (db.session.query(column, func.count(Scrobble.id), func.max(Scrobble.played_at))
+                         .join(Match, Plex.id == Match.plex_id)
+                         .join(LastfmTrack, Match.id == LastfmTrack.match_id)
+                         .join(Scrobble, LastfmTrack.id == Scrobble.track_id)
+                         .filter(column.in_(touched_guids))
+                         .group_by(column)
+                         .all())
 
-def update_settings_row(guid, viewed_at, view_count):
-    update_sql = '''UPDATE metadata_item_settings SET last_viewed_at=?, view_count=? WHERE account_id=? AND guid=?'''
-    account = db.session.query(Account).first()
+    timestamp = int(time.time())
     with sqlite3.connect(account.plex_db_file) as conn:
         c = conn.cursor()
-        c.execute(update_sql, [viewed_at, view_count, account.plex_account_id, guid])
+        # Only the settings rows of the touched guids are looked up, not every row of the account
+        touched_guids = list(dict.fromkeys(guid for (guid, _, _) in all_info))
+        li_settings_guids = set()
+        for i in range(0, len(touched_guids), 500):
+            chunk = touched_guids[i:i + 500]
+            settings_rows = c.execute(select_settings_guids.format(', '.join('?' * len(chunk))),
+                                      [account.plex_account_id, *chunk])
+            li_settings_guids.update(guid for (guid,) in settings_rows)
+        c.executemany(insert_views, [
+            [account.plex_account_id, guid, account.plex_music_library_id, artist, parent_index, album,
+             track_index, track, played_at, grandparent_guid, account.plex_device_id]
+            for (_, guid, artist, parent_index, album, track_index, track, played_at, grandparent_guid, _) in views
+        ])
+        # The write lock is held until commit, so the new views occupy a contiguous block of ids
+        last_view_id = c.execute('''SELECT MAX(id) FROM metadata_item_views''').fetchone()[0]
+        c.executemany(insert_settings, [
+            [account.plex_account_id, guid, timestamp, timestamp]
+            for guid in touched_guids if guid not in li_settings_guids
+        ])
+        c.executemany(update_settings_delta if incremental else update_settings, [
+            [viewed_at, view_count, account.plex_account_id, guid] for (guid, view_count, viewed_at) in all_info
+        ])
         conn.commit()
-    return
-
 
-def add_scrobbles_to_plex():
-    select_settings_guids = '''SELECT metadata_item_settings.guid, metadata_items.metadata_type
-                               FROM metadata_item_settings
-                               LEFT JOIN metadata_items ON metadata_item_settings.guid = metadata_items.guid
-                               WHERE metadata_item_settings.account_id=?
-                                   AND metadata_items.metadata_type = 8 
-                                   OR metadata_items.metadata_type = 9
-                                   OR metadata_items.metadata_type = 10
-                               ORDER BY metadata_items.metadata_type'''
-    account = db.session.query(Account).first()
-    scrobbles = db.session.query(Scrobble).filter(Scrobble.status == 'matched').all()
-    scrobbles_processing_df = pd.DataFrame.from_records([scrobble.processing_data() for scrobble in scrobbles])
-    with sqlite3.connect(account.plex_db_file) as conn:
-        scrobbles_processing_df.to_sql('metadata_item_views', con=conn, if_exists='append', index=False)
-    id_list_unq = np.array(np.unique([scrobble.match.plex_id for scrobble in scrobbles])).tolist()
-    track_info = [{'guid': x, 'count': y, 'viewed_at': z} for (x, y, z) in
-                  (db.session.query(Plex.guid, func.count(Plex.match), func.max(Scrobble.played_at))
-                   .join(Match, Plex.id == Match.plex_id)
-                   .join(Scrobble, Match.id == Scrobble.match_id)
-                   .filter(Plex.id.in_(id_list_unq))
-                   .group_by(Plex.guid).all())]
-    album_guid_list = [item[0] for item in (db.session.query(Plex.parent_guid)
-                                            .filter(Plex.id.in_(id_list_unq))
-                                            .group_by(Plex.parent_guid).all())]
-    album_info = [{'guid': x, 'count': y, 'viewed_at': z} for (x, y, z) in
-                  (db.session.query(Plex.parent_guid, func.count(Plex.match), func.max(Scrobble.played_at))
-                   .join(Match, Plex.id == Match.plex_id)
-                   .join(Scrobble, Match.id == Scrobble.match_id)
-                   .filter(Plex.parent_guid.in_(album_guid_list))
-                   .group_by(Plex.parent_guid).all())]
-    artist_guid_list = [item[0] for item in (db.session.query(Plex.grandparent_guid)
-                                             .filter(Plex.id.in_(id_list_unq))
-                                             .group_by(Plex.grandparent_guid).all())]
-    artist_info = [{'guid': x, 'count': y, 'viewed_at': z} for (x, y, z) in
-                   (db.session.query(Plex.grandparent_guid, func.count(Plex.match), func.max(Scrobble.played_at))
-                    .join(Match, Plex.id == Match.plex_id)
-                    .join(Scrobble, Match.id == Scrobble.match_id)
-                    .filter(Plex.grandparent_guid.in_(artist_guid_list))
-                    .group_by(Plex.grandparent_guid).all())]
-    all_info = track_info + album_info + artist_info
-    li_all_guids = [x['guid'] for x in all_info]
-    with sqlite3.connect(account.plex_db_file) as conn:
-        li_settings_guids = (pd.read_sql(select_settings_guids, con=conn, params=[account.plex_account_id])['guid']
-                             .to_list())
-    li_new_guids = np.setdiff1d(li_all_guids, li_settings_guids)
-
-    timestamp = int(time.time())
-    created_at, updated_at = timestamp, timestamp
-
-    for guid in li_new_guids:
-        create_settings_row(guid, created_at, updated_at)
-
-    for row in all_info:
-        guid = row['guid']
-        viewed_at = row['viewed_at']
-        view_count = row['count']
-        update_settings_row(guid, viewed_at, view_count)
-
-    for scrobble in scrobbles:
-        scrobble.status = 'processed'
+    db.session.execute(
+        Scrobble.__table__.update().where(Scrobble.id == bindparam('b_id')).values(status='processed'),
+        [{'b_id': view[0]} for view in views])
+    first_view_id = last_view_id - len(views) + 1
+    db.session.execute(insert(PlexWrite), [
+        {'scrobble_id': view[0], 'view_id': first_view_id + i, 'guid': view[1], 'parent_guid': view[9],
+         'grandparent_guid': view[8]}
+        for (i, view) in enumerate(views)
+    ])
+    account.last_plex_update = datetime.utcnow()
     db.session.commit()
 
     return
@@ -129,72 +140,97 @@ def add_scrobbles_to_plex():
 
 def delete_plex_plays():
     account = db.session.query(Account).first()
-    query = select(Plex)
-    plex_df = pd.read_sql(query, con=db.engine)[['guid', 'parent_guid', 'grandparent_guid', 'album']]
+    create_deltas = '''CREATE TEMP TABLE plex_deltas (guid TEXT PRIMARY KEY, n INTEGER)'''
+    insert_deltas = '''WITH played AS (
+                           SELECT v.guid, p.parent_guid, v.grandparent_guid, v.n
+                           FROM (SELECT guid, grandparent_guid, parent_title, COUNT(*) AS n
+                                 FROM main.metadata_item_views
+                                 WHERE account_id=? AND metadata_type=10 AND device_id!=?
+                                 GROUP BY guid, grandparent_guid, parent_title) AS v
+                           LEFT JOIN (SELECT DISTINCT guid, parent_guid, grandparent_guid, album
+                                      FROM hex.plex_tracks) AS p
+                               ON p.guid = v.guid AND p.grandparent_guid = v.grandparent_guid
+                                   AND p.album = v.parent_title)
+                       INSERT INTO temp.plex_deltas (guid, n)
+                       SELECT guid, SUM(n)
+                       FROM (SELECT guid, n FROM played
+                             UNION ALL SELECT parent_guid, n FROM played
+                             UNION ALL SELECT grandparent_guid, n FROM played)
+                       WHERE guid IS NOT NULL
+                       GROUP BY guid'''
+    update_sql = '''UPDATE metadata_item_settings
+                    SET view_count=MAX(view_count-(SELECT n FROM temp.plex_deltas AS d
+                                                   WHERE d.guid=metadata_item_settings.guid), 0)
+                    WHERE account_id=? AND view_count>0 AND guid IN (SELECT guid FROM temp.plex_deltas)'''
     delete_sql = '''DELETE FROM metadata_item_views
                     WHERE account_id=? AND metadata_type=10 AND device_id!=?'''
-    select_sql = '''SELECT guid, grandparent_guid, parent_title 
-                    FROM metadata_item_views 
-                    WHERE account_id=? AND metadata_type=10 AND device_id!=?'''
-    update_sql = '''UPDATE metadata_item_settings
-                    SET view_count=view_count-1
-                    WHERE guid=? AND view_count>0 AND account_id=?'''
-    select_all_guids = '''SELECT guid
-                          FROM metadata_items
-                          WHERE metadata_items.metadata_type = 8 
-                              OR metadata_items.metadata_type = 9
-                              OR metadata_items.metadata_type = 10'''
-    select_settings_guids = '''SELECT metadata_item_settings.guid, metadata_items.metadata_type
-                               FROM metadata_item_settings
-                               LEFT JOIN metadata_items ON metadata_item_settings.guid = metadata_items.guid
-                               WHERE metadata_item_settings.account_id=?
-                                   AND metadata_items.metadata_type = 8 
-                                   OR metadata_items.metadata_type = 9
-                                   OR metadata_items.metadata_type = 10
-                               ORDER BY metadata_items.metadata_type'''
-    delete_settings_row = '''DELETE FROM metadata_item_settings
-                             WHERE account_id=? AND guid=?'''
     with sqlite3.connect(account.plex_db_file) as conn:
         c = conn.cursor()
-        li_all_guids = pd.read_sql(select_all_guids, con=conn)['guid'].to_list()
-        li_settings_guids = (pd.read_sql(select_settings_guids, con=conn, params=[account.plex_account_id])['guid']
-                             .to_list())
-        s = set(li_all_guids)
-        diff_guids = [x for x in li_settings_guids if x not in s]
-        for guid in diff_guids:
-            c.execute(delete_settings_row, [account.plex_account_id, guid])
-        df = pd.read_sql(select_sql, con=conn, params=[account.plex_account_id, account.plex_device_id])
-        df = df.merge(
-            plex_df.drop_duplicates(),
-            left_on=['guid', 'grandparent_guid', 'parent_title'],
-            right_on=['guid', 'grandparent_guid', 'album'],
-            how='left')
-        guids = df['guid'].tolist() + df['parent_guid'].tolist() + df['grandparent_guid'].tolist()
-        for guid in guids:
-            c.execute(update_sql, [guid, account.plex_account_id])
+        c.execute('''ATTACH DATABASE ? AS hex''', [db.engine.url.database])
+        c.execute(create_deltas)
+        c.execute(insert_deltas, [account.plex_account_id, account.plex_device_id])
+        c.execute(update_sql, [account.plex_account_id])
         c.execute(delete_sql, [account.plex_account_id, account.plex_device_id])
         conn.commit()
+        c.execute('''DROP TABLE temp.plex_deltas''')
+        c.execute('''DETACH DATABASE hex''')
     return
 
 
-def get_plex_df():
+def plex_changed_since(alias):
+    return f'''MAX(COALESCE({alias}.updated_at, 0), COALESCE({alias}.added_at, 0)) >= :since'''
+
+
+def get_plex_watermark():
+    account = db.session.query(Account).first()
+    select_watermark = f'''SELECT MAX(MAX(COALESCE(updated_at, 0), COALESCE(added_at, 0))) FROM metadata_items
+                          WHERE metadata_type IN (8, 9, 10)'''
+    with sqlite3.connect(account.plex_db_file) as conn:
+        return conn.execute(select_watermark).fetchone()[0]
+
+
+def get_plex_rating_keys():
+    # Same rows get_plex_df keeps, without reading anything but the id
+    account = db.session.query(Account).first()
+    select_ids = '''SELECT id FROM metadata_items
+                   WHERE metadata_type=10 AND title IS NOT NULL AND original_title IS NOT NULL
+                   AND "index" IS NOT NULL AND guid IS NOT NULL AND parent_id IS NOT NULL'''
+    with sqlite3.connect(account.plex_db_file) as conn:
+        return np.array([rating_key for (rating_key,) in conn.execute(select_ids)], dtype=np.int64)
+
+
+def plex_fingerprints(df):
+    # 64-bit fingerprint of the stored content of each track. Index columns are compared as integers, since they come
+    # back from the databases as either int or float depending on whether the column holds NULLs.
+    key = pd.Series('', index=df.index)
+    for column in PLEX_FINGERPRINT_COLUMNS:
+        values = df[column].astype('Int64') if column.endswith('index') else df[column]
+        key = key + '\x1f' + values.astype(str).where(values.notna(), '\x00')
+    return pd.util.hash_pandas_object(key, index=False).to_numpy().view(np.int64)
+
+
+def get_plex_df(since=None):
     account = db.session.query(Account).first()
-    select_tracks = f'''SELECT * FROM metadata_items WHERE metadata_type=10'''
-    select_albums = f'''SELECT * FROM metadata_items WHERE metadata_type=9'''
-    select_artists = f'''SELECT * FROM metadata_items WHERE metadata_type=8'''
+    # Tracks joined to their album and artist inside the Plex database, reading only the columns plex_tracks keeps
+    select_tracks = f'''SELECT t.id AS rating_key, t.title AS track, t.original_title AS artist_feat,
+                               t."index" AS track_index, t.guid AS guid, al.title AS album, al."index" AS parent_index,
+                               al.guid AS parent_guid, ar.title AS artist, ar.guid AS grandparent_guid
+                        FROM metadata_items t
+                        LEFT JOIN metadata_items al ON al.id=t.parent_id AND al.metadata_type=9
+                        LEFT JOIN metadata_items ar ON ar.id=al.parent_id AND ar.metadata_type=8
+                        WHERE t.metadata_type=10 AND t.title IS NOT NULL AND t.original_title IS NOT NULL
+                        AND t."index" IS NOT NULL AND t.guid IS NOT NULL AND t.parent_id IS NOT NULL'''
+    if since is not None:
+        # Tracks touched since the watermark, or whose album or artist was
+        select_tracks += f''' AND ({plex_changed_since('t')} OR {plex_changed_since('al')}
+                              OR {plex_changed_since('ar')})'''
+    select_tracks += ''' ORDER BY t.id'''
     with sqlite3.connect(account.plex_db_file) as conn:
-        df = pd.read_sql(select_tracks, conn)
-        df_album_info = pd.read_sql(select_albums, conn)
-        df_artist_info = pd.read_sql(select_artists, conn)
-    df = df.filter(['id', 'title', 'original_title', 'index', 'guid', 'parent_id']).dropna()
-    df = pd.DataFrame\
-        .merge(df, df_album_info, left_on='parent_id', right_on='id', how='left', suffixes=('_track', '_album'))
-    df = pd.DataFrame\
-        .merge(df, df_artist_info, left_on='parent_id_album', right_on='id', how='left', suffixes=('', '_artist'))\
-        .filter(cols_filter)\
-        .rename(columns=rename)
+        df = pd.read_sql(select_tracks, conn, params={'since': since})
     df.artist_feat = np.where(df.artist_feat.str.len() > 0, df.artist_feat, df.artist)
     df['concat_plex'] = df['artist_feat'] + ' --- ' + df['album'] + ' --- ' + df['track']
+    df['fingerprint'] = plex_fingerprints(df)
+    df['match_key'], df['artist_track_key'] = match_keys(df['artist_feat'], df['album'], df['track'])
     return df
 
 
@@ -204,7 +240,7 @@ def get_plex_df():
 
 
 def delete_orphan_match_rows():
-    matches = db.session.query(Match, func.count(Match.scrobbles)).outerjoin(Scrobble).group_by(Match.id).all()
+    matches = db.session.query(Match, func.count(LastfmTrack.id)).outerjoin(LastfmTrack).group_by(Match.id).all()
     filtered = list(filter(lambda match: match[1] == 0, matches))
     for match in filtered:
         db.session.delete(match[0])
@@ -212,67 +248,428 @@ def delete_orphan_match_rows():
     return
 
 
-def delete_single_plex_play(scrobble, guids=[]):
-    account = db.session.query(Account).first()
+def get_hex_plex_df(rating_keys=None, columns=None, chunk_size=500):
+    query = select(Plex) if columns is None else select(*[getattr(Plex, column) for column in columns])
+    if rating_keys is None or len(rating_keys) > chunk_size * 20:
+        # Past a few thousand keys one scan is cheaper than many IN lookups
+        df = pd.read_sql(query, con=db.engine, dtype={'fingerprint': 'Int64'})
+        if rating_keys is not None:
+            df = df[df['rating_key'].isin(rating_keys)]
+    else:
+        chunks = [query.where(Plex.rating_key.in_(rating_keys[i:i + chunk_size]))
+                  for i in range(0, len(rating_keys), chunk_size)] or [query.where(False)]
+        df = pd.concat([pd.read_sql(chunk, con=db.engine, dtype={'fingerprint': 'Int64'}) for chunk in chunks])
+    return df.drop(['id'], axis=1, errors='ignore').reset_index(drop=True)
+
+
+def get_hex_plex_fingerprints(rating_keys=None):
+    df = get_hex_plex_df(rating_keys, columns=['rating_key', 'fingerprint'])
+    missing = df['fingerprint'].isna()
+    if missing.any():
+        # Rows stored before fingerprints existed are fingerprinted from their stored columns once
+        df_missing = get_hex_plex_df(df.loc[missing, 'rating_key'].tolist())
+        fingerprints = dict(zip(df_missing['rating_key'], plex_fingerprints(df_missing)))
+        db.session.execute(
+            Plex.__table__.update().where(Plex.rating_key == bindparam('b_rating_key'))
+            .values(fingerprint=bindparam('b_fingerprint')),
+            [{'b_rating_key': int(rating_key), 'b_fingerprint': int(fingerprint)}
+             for (rating_key, fingerprint) in fingerprints.items()])
+        db.session.commit()
+        df.loc[missing, 'fingerprint'] = df.loc[missing, 'rating_key'].map(fingerprints)
+    return df.astype({'fingerprint': np.int64})
+
+
+def reverse_plex_plays(scrobble_filter, guids={}):
+    delete_journal_sql = '''DELETE FROM metadata_item_views WHERE id=? AND guid=?'''
     delete_sql = '''DELETE FROM metadata_item_views WHERE account_id=? AND viewed_at=? AND guid=?'''
     update_sql = '''UPDATE metadata_item_settings
-                    SET view_count=view_count-1
+                    SET view_count=MAX(view_count-?, 0)
                     WHERE guid=? AND view_count>0 AND account_id=?'''
-    if len(guids) == 0:
-      guids = [scrobble.match.plex_track.grandparent_guid,
-              scrobble.match.plex_track.parent_guid,
-              scrobble.match.plex_track.guid]
+    scrobble_ids = select(Scrobble.id).where(scrobble_filter, Scrobble.status == 'processed')
+    plays = (db.session.query(Scrobble.played_at, PlexWrite.view_id, PlexWrite.guid, PlexWrite.parent_guid,
+                              PlexWrite.grandparent_guid, Plex.rating_key, Plex.guid, Plex.parent_guid,
+                              Plex.grandparent_guid)
+             .outerjoin(PlexWrite, Scrobble.id == PlexWrite.scrobble_id)
+             .outerjoin(LastfmTrack, Scrobble.track_id == LastfmTrack.id)
+             .outerjoin(Match, LastfmTrack.match_id == Match.id)
+             .outerjoin(Plex, Match.plex_id == Plex.id)
+             .filter(Scrobble.id.in_(scrobble_ids))
+             .all())
+    if len(plays) == 0:
+        return
+    account = db.session.query(Account).first()
+    journal_view_ids = []
+    unjournaled_views = []
+    deltas = Counter()
+    for (played_at, view_id, guid, parent_guid, grandparent_guid, rating_key, plex_guid, plex_parent_guid,
+         plex_grandparent_guid) in plays:
+        if view_id is not None:
+            journal_view_ids.append([view_id, guid])
+            deltas.update([grandparent_guid, parent_guid, guid])
+        else:
+            # Plays written before the journal existed are located by timestamp and track guid
+            unjournaled_views.append([account.plex_account_id, played_at, plex_guid])
+            deltas.update(guids.get(rating_key) or [plex_grandparent_guid, plex_parent_guid, plex_guid])
     with sqlite3.connect(account.plex_db_file) as conn:
         c = conn.cursor()
-        c.execute(delete_sql, [account.plex_account_id, scrobble.played_at, scrobble.match.plex_track.guid])
-        for guid in guids:
-            c.execute(update_sql, [guid, account.plex_account_id])
+        c.executemany(delete_journal_sql, journal_view_ids)
+        c.executemany(delete_sql, unjournaled_views)
+        c.executemany(update_sql, [[count, guid, account.plex_account_id] for (guid, count) in deltas.items()])
         conn.commit()
+    (db.session.query(PlexWrite)
+     .filter(PlexWrite.scrobble_id.in_(scrobble_ids))
+     .delete(synchronize_session=False))
+    return
+
+
+def process_unmatch(rating_keys, delete_tracks=False, guids={}, chunk_size=5000):
+    # Unmatches every track in rating_keys with set-based statements, chunked to stay under SQLite's variable limit.
+    # guids optionally maps a rating key to the guids whose view counts are decremented for its older plays.
+    rating_keys = [int(rating_key) for rating_key in rating_keys]
+    for i in range(0, len(rating_keys), chunk_size):
+        chunk = rating_keys[i:i + chunk_size]
+        plex_ids = select(Plex.id).where(Plex.rating_key.in_(chunk))
+        match_ids = [match_id for (match_id,) in db.session.query(Match.id).filter(Match.plex_id.in_(plex_ids))]
+        if len(match_ids) > 0:
+            reverse_plex_plays(match_scrobbles_filter(match_ids), guids)
+            unlink_matches(match_ids)
+            db.session.query(Match).filter(Match.id.in_(match_ids)).delete(synchronize_session=False)
+        if delete_tracks:
+            db.session.query(AddedTrack).filter(AddedTrack.rating_key.in_(chunk)).delete(synchronize_session=False)
+            db.session.query(Plex).filter(Plex.rating_key.in_(chunk)).delete(synchronize_session=False)
     return
 
 
-def process_unmatch(rating_key, delete_track=False, guids=[]):
-    plex_track = db.session.query(Plex).filter(Plex.rating_key == int(rating_key)).one()
-    matches = plex_track.match.all()
-    for match in matches:
-        scrobbles = match.scrobbles.all()
-        for scrobble in scrobbles:
-            if scrobble.status == 'processed':
-                delete_single_plex_play(scrobble, guids)
-            scrobble.match_id = None
-            scrobble.status = None
-        db.session.delete(match)
-    if delete_track:
-        added_tracks = db.session.query(AddedTrack).filter(AddedTrack.rating_key == int(rating_key)).all()
-        for track in added_tracks:
-            db.session.delete(track)
-        db.session.delete(plex_track)
+def match_scrobbles_filter(match_ids):
+    return Scrobble.track_id.in_(select(LastfmTrack.id).where(LastfmTrack.match_id.in_(match_ids)))
+
+
+def unlink_matches(match_ids):
+    # Returns the Last.fm tracks of these matches, and their scrobbles, to unreviewed
+    (db.session.query(Scrobble)
+     .filter(match_scrobbles_filter(match_ids))
+     .update({Scrobble.status: None}, synchronize_session=False))
+    (db.session.query(LastfmTrack)
+     .filter(LastfmTrack.match_id.in_(match_ids))
+     .update({LastfmTrack.match_id: None}, synchronize_session=False))
+    db.session.query(MatchPlay).filter(MatchPlay.match_id.in_(match_ids)).delete(synchronize_session=False)
     return
 
 
-def search_match(scrobble):
-    match = (db.session.query(Match)
-             .filter(func.lower(Match.concat_lastfm) == func.lower(scrobble.concat_lastfm))
-             .first())
-    if match:
-        scrobble.match_id = match.id
-        if match.plex_id == 0:
-            scrobble.status = 'unmatched'
+def match_play_counts():
+    return (select(LastfmTrack.match_id, (Scrobble.played_at // 86400).label('day'), func.count(Scrobble.id))
+            .join(Scrobble, Scrobble.track_id == LastfmTrack.id)
+            .group_by(LastfmTrack.match_id, 'day'))
+
+
+def refresh_match_plays(match_ids, chunk_size=500):
+    # Recounts the per-day plays of these matches after their tracks or scrobbles changed
+    match_ids = list(set(match_ids))
+    for i in range(0, len(match_ids), chunk_size):
+        chunk = match_ids[i:i + chunk_size]
+        db.session.query(MatchPlay).filter(MatchPlay.match_id.in_(chunk)).delete(synchronize_session=False)
+        db.session.execute(insert(MatchPlay).from_select(
+            ['match_id', 'day', 'plays'], match_play_counts().where(LastfmTrack.match_id.in_(chunk))))
+    return
+
+
+def rebuild_match_plays():
+    db.session.query(MatchPlay).delete(synchronize_session=False)
+    db.session.execute(insert(MatchPlay).from_select(
+        ['match_id', 'day', 'plays'], match_play_counts().where(LastfmTrack.match_id != null())))
+    db.session.commit()
+    return db.session.query(MatchPlay).count()
+
+
+def match_plays_between(start=None, end=None):
+    # Plays per match for scrobbles with start <= played_at <= end, as (match_id, plays) rows that can repeat a match.
+    # Whole days inside the range are read from the rollup; the partial days at either edge are counted from the
+    # scrobbles themselves, so the totals are the same as counting every scrobble in the range.
+    rollup = select(MatchPlay.match_id, MatchPlay.plays)
+    if start is None and end is None:
+        return rollup.subquery()
+    edges = select(LastfmTrack.match_id, func.count(Scrobble.id).label('plays')).join(
+        Scrobble, Scrobble.track_id == LastfmTrack.id).where(LastfmTrack.match_id != null())
+    edge_filter = []
+    if start is not None:
+        first_day = int(-(-start // 86400))
+        rollup = rollup.where(MatchPlay.day >= first_day)
+        edges = edges.where(Scrobble.played_at >= start)
+        edge_filter.append(Scrobble.played_at < first_day * 86400)
+    if end is not None:
+        last_day = int((end + 1) // 86400) - 1
+        rollup = rollup.where(MatchPlay.day <= last_day)
+        edges = edges.where(Scrobble.played_at <= end)
+        edge_filter.append(Scrobble.played_at >= (last_day + 1) * 86400)
+    edges = edges.where(or_(*edge_filter)).group_by(LastfmTrack.match_id)
+    return union_all(rollup, edges).subquery()
+
+
+def encode_match_cursor(direction, key):
+    return base64.urlsafe_b64encode(json.dumps([direction, *key]).encode()).decode()
+
+
+def decode_match_cursor(cursor):
+    try:
+        direction, *key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    if direction not in ('next', 'prev') or len(key) != 2:
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return direction, key
+
+
+def match_sort_key(active_col, plays):
+    if active_col == 1:
+        return Match.concat_lastfm
+    if active_col == 2:
+        # Unmatched rows have no Plex track and sort where SQLite puts NULLs
+        return func.coalesce(Plex.concat_plex, '')
+    if active_col == 3:
+        return func.sum(plays.c.plays)
+    return Match.id
+
+
+def match_keyset_page(query_filter, plays, active_col, order_by, cursor, per_page=MATCH_PAGE_SIZE):
+    # Seeks past the (sort value, match id) of the cursor instead of counting an OFFSET, so every page costs the same
+    sort_key = match_sort_key(active_col, plays)
+    direction, key = decode_match_cursor(cursor) if cursor else ('next', None)
+    descending = (order_by == 'desc') != (direction == 'prev')
+    order = desc if descending else asc
+    query = (db.session.query(Match, func.sum(plays.c.plays), sort_key)
+             .join(plays, plays.c.match_id == Match.id)
+             .filter(query_filter)
+             .group_by(Match))
+    if active_col == 2:
+        query = query.join(Plex, isouter=True)
+    if key is not None:
+        position = tuple_(sort_key, Match.id)
+        seek = position < tuple_(*key) if descending else position > tuple_(*key)
+        query = query.having(seek) if active_col == 3 else query.filter(seek)
+    rows = query.order_by(order(sort_key), order(Match.id)).limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if direction == 'prev':
+        rows.reverse()
+    next_cursor = None
+    prev_cursor = None
+    if len(rows) > 0:
+        first = encode_match_cursor('prev', [rows[0][2], rows[0][0].id])
+        last = encode_match_cursor('next', [rows[-1][2], rows[-1][0].id])
+        if direction == 'next':
+            next_cursor = last if has_more else None
+            prev_cursor = first if key is not None else None
         else:
-            scrobble.status = 'matched'
-    else:
-        plex_track = (db.session.query(Plex)
-                      .filter(func.lower(Plex.concat_plex) == func.lower(scrobble.concat_lastfm))
-                      .first())
-        if plex_track:
-            match = Match(concat_lastfm=scrobble.concat_lastfm, plex_id=plex_track.id)
-            db.session.add(match)
-            db.session.flush()
-            scrobble.match_id = match.id
-            scrobble.status = 'matched'
+            next_cursor = last
+            prev_cursor = first if has_more else None
+    return [(match, playcount) for (match, playcount, _) in rows], next_cursor, prev_cursor
+
+
+def cached_match_count(cache_key, query_filter, plays):
+    # Paging through a listing reuses its grouped total until matches or scrobbles change
+    return generation_cached(('match_count', *cache_key), ['matches', 'scrobbles'], lambda: (
+        db.session.query(func.count(Match.id.distinct()))
+        .join(plays, plays.c.match_id == Match.id)
+        .filter(query_filter)
+        .scalar()
+    ))
+
+
+# Data generations: every write path bumps the counters of what it changed, so cached reads can tell whether they
+# are still current. 'matches' also covers the match links of lastfm_tracks and the match_plays rollup.
+GENERATIONS = ['accounts', 'added_tracks', 'matches', 'plex_tracks', 'scrobbles']
+generation_cache = {}
+
+
+def bump_generations(*names):
+    insert_stmt = sqlite_insert(Generation).values([{'name': name, 'value': 1} for name in names])
+    db.session.execute(insert_stmt.on_conflict_do_update(index_elements=['name'],
+                                                         set_={'value': Generation.value + 1}))
+    db.session.commit()
+    return
+
+
+def get_generations(names=GENERATIONS):
+    values = dict(db.session.query(Generation.name, Generation.value).filter(Generation.name.in_(names)))
+    return tuple(values.get(name, 0) for name in names)
+
+
+def get_instance_token():
+    # A random value stored with the generations the first time it is asked for, so counters that restart from zero in
+    # a recreated database never repeat the tags the old one handed out
+    token = db.session.query(Generation.value).filter(Generation.name == 'instance').scalar()
+    if token is None:
+        db.session.execute(sqlite_insert(Generation).values(name='instance', value=secrets.randbits(62))
+                           .on_conflict_do_nothing(index_elements=['name']))
+        db.session.commit()
+        token = db.session.query(Generation.value).filter(Generation.name == 'instance').scalar()
+    return token
+
+
+def generation_cached(cache_key, names, compute):
+    generations = get_generations(names)
+    cached = generation_cache.get(cache_key)
+    if cached is not None and cached[0] == generations:
+        return cached[1]
+    value = compute()
+    if len(generation_cache) > 256:
+        generation_cache.clear()
+    generation_cache[cache_key] = (generations, value)
+    return value
+
+
+def insert_matches(rows):
+    max_match_id = db.session.query(func.max(Match.id)).scalar() or 0
+    db.session.execute(insert(Match), rows)
+    return {concat_lastfm.lower(): match_id for (match_id, concat_lastfm) in
+            db.session.query(Match.id, Match.concat_lastfm).filter(Match.id > max_match_id)}
+
+
+def update_scrobble_matches(rows):
+    if len(rows) == 0:
+        return
+    track_ids = select(LastfmTrack.id).where(LastfmTrack.concat_lastfm == bindparam('b_concat_lastfm'))
+    status_stmt = (Scrobble.__table__.update()
+                   .where(Scrobble.track_id.in_(track_ids), Scrobble.status == null())
+                   .values(status=bindparam('b_status')))
+    match_stmt = (LastfmTrack.__table__.update()
+                  .where(LastfmTrack.concat_lastfm == bindparam('b_concat_lastfm'), LastfmTrack.match_id == null())
+                  .values(match_id=bindparam('b_match_id')))
+    db.session.execute(status_stmt, rows)
+    db.session.execute(match_stmt, [{key: row[key] for key in ['b_concat_lastfm', 'b_match_id']} for row in rows])
+    refresh_match_plays([row['b_match_id'] for row in rows])
+    return
+
+
+def update_matched_scrobble_status():
+    # New plays of a Last.fm track that is already matched take the status of that match
+    plex_id = select(Match.plex_id).where(Match.id == LastfmTrack.match_id).scalar_subquery()
+    track_status = (select(case((plex_id == 0, 'unmatched'), else_='matched'))
+                    .where(LastfmTrack.id == Scrobble.track_id)
+                    .scalar_subquery())
+    matched_tracks = select(LastfmTrack.id).where(LastfmTrack.match_id != null())
+    result = (db.session.query(Scrobble)
+              .filter(Scrobble.status == null(), Scrobble.track_id.in_(matched_tracks))
+              .update({Scrobble.status: track_status}, synchronize_session=False))
+    return result
+
+
+FEAT_PATTERNS = [r'[\(\[]\s*(?:feat|ft|featuring|with)\b\.?[^\)\]]*[\)\]]', r'\s(?:feat|ft|featuring)\b\.?\s.*$']
+ALBUM_EDITION_PATTERNS = [
+    r'[\(\[][^\)\]]*\b(?:deluxe|remaster(?:ed)?|edition|expanded|anniversary|bonus)\b[^\)\]]*[\)\]]',
+    r'\s-\s[^-]*\b(?:deluxe|remaster(?:ed)?|edition|expanded|anniversary)\b.*$'
+]
+TRACK_EDITION_PATTERNS = [r'[\(\[][^\)\]]*\bremaster(?:ed)?\b[^\)\]]*[\)\]]', r'\s-\s[^-]*\bremaster(?:ed)?\b.*$']
+
+
+def normalize_match_text(values, patterns=[]):
+    # Case, accents, featured-artist credits, the given edition suffixes and punctuation are ignored
+    values = values.fillna('').astype(str).str.normalize('NFKD').str.replace(r'[\u0300-\u036f]', '', regex=True)
+    values = values.str.casefold().str.replace('&', ' and ', regex=False)
+    for pattern in FEAT_PATTERNS + patterns:
+        values = values.str.replace(pattern, '', regex=True)
+    return values.str.replace(r'[\W_]+', ' ', regex=True).str.strip()
+
+
+def match_keys(artist, album, track):
+    # Exact-lookup tiers: normalized artist/album/track, then normalized artist/track ignoring the album
+    artist = normalize_match_text(artist)
+    album = normalize_match_text(album, ALBUM_EDITION_PATTERNS)
+    track = normalize_match_text(track, TRACK_EDITION_PATTERNS)
+    valid = (artist != '') & (track != '')
+    match_key = (artist + '|' + album + '|' + track).where(valid, None)
+    artist_track_key = (artist + '|' + track).where(valid, None)
+    return match_key, artist_track_key
+
+
+def fill_match_keys(chunk_size=50000):
+    # Rows stored before match keys existed get them computed in id-ordered chunks
+    for (model, artist_column) in [(LastfmTrack, LastfmTrack.artist), (Plex, Plex.artist_feat)]:
+        update_stmt = (model.__table__.update()
+                       .where(model.id == bindparam('b_id'))
+                       .values(match_key=bindparam('b_match_key'), artist_track_key=bindparam('b_artist_track_key')))
+        last_id = 0
+        while True:
+            query = (select(model.id, artist_column.label('artist'), model.album, model.track)
+                     .where(model.match_key == null(), model.id > last_id)
+                     .order_by(model.id)
+                     .limit(chunk_size))
+            df = pd.read_sql(query, con=db.session.connection())
+            if df.empty:
+                break
+            df['match_key'], df['artist_track_key'] = match_keys(df['artist'], df['album'], df['track'])
+            rows = df[df['match_key'].notna()]
+            if len(rows) > 0:
+                db.session.execute(update_stmt, [
+                    {'b_id': int(row_id), 'b_match_key': match_key, 'b_artist_track_key': artist_track_key}
+                    for (row_id, match_key, artist_track_key) in
+                    rows[['id', 'match_key', 'artist_track_key']].itertuples(index=False)
+                ])
+            last_id = int(df['id'].iloc[-1])
     return
 
 
+def batch_match_unreviewed():
+    matched_count = update_matched_scrobble_status()
+    fill_match_keys()
+    unreviewed = (db.session.query(LastfmTrack.concat_lastfm, LastfmTrack.match_key, LastfmTrack.artist_track_key,
+                                   func.count(Scrobble.id))
+                  .join(Scrobble, LastfmTrack.id == Scrobble.track_id)
+                  .filter(LastfmTrack.match_id == null())
+                  .group_by(LastfmTrack.id)
+                  .order_by(func.min(Scrobble.id))
+                  .all())
+    if len(unreviewed) == 0:
+        return matched_count
+    # Case-insensitive hash joins against existing matches, then against the Plex library: the whole string first,
+    # then the normalized key, then the normalized artist and track when only one Plex track has them
+    match_lookup = {}
+    for (match_id, concat_lastfm, plex_id) in (db.session.query(Match.id, Match.concat_lastfm, Match.plex_id)
+                                               .order_by(Match.id)):
+        match_lookup.setdefault(concat_lastfm.lower(), (match_id, plex_id))
+    plex_lookup = {}
+    match_key_lookup = {}
+    artist_track_lookup = {}
+    for (plex_id, concat_plex, match_key, artist_track_key) in (db.session.query(Plex.id, Plex.concat_plex,
+                                                                                 Plex.match_key, Plex.artist_track_key)
+                                                                .order_by(Plex.id)):
+        if concat_plex is not None:
+            plex_lookup.setdefault(concat_plex.lower(), plex_id)
+        if match_key is not None:
+            # A normalized key shared by several Plex tracks is ambiguous, so it is dropped rather than guessed
+            match_key_lookup[match_key] = plex_id if match_key not in match_key_lookup else None
+            artist_track_lookup[artist_track_key] = plex_id if artist_track_key not in artist_track_lookup else None
+    existing_tier = []
+    new_matches = {}
+    plex_tier = []
+    for (concat_lastfm, match_key, artist_track_key, count) in unreviewed:
+        key = concat_lastfm.lower()
+        plex_id = (plex_lookup.get(key) or match_key_lookup.get(match_key)
+                   or artist_track_lookup.get(artist_track_key))
+        if key in match_lookup:
+            match_id, plex_id = match_lookup[key]
+            existing_tier.append({
+                'b_concat_lastfm': concat_lastfm,
+                'b_match_id': match_id,
+                'b_status': 'unmatched' if plex_id == 0 else 'matched'
+            })
+        elif plex_id is not None:
+            new_matches.setdefault(key, {'concat_lastfm': concat_lastfm, 'plex_id': plex_id})
+            plex_tier.append((key, concat_lastfm))
+        else:
+            continue
+        matched_count += count
+    if len(new_matches) > 0:
+        created = insert_matches(list(new_matches.values()))
+        plex_tier = [
+            {'b_concat_lastfm': concat_lastfm, 'b_match_id': created[key], 'b_status': 'matched'}
+            for (key, concat_lastfm) in plex_tier
+        ]
+    for tier in [existing_tier, plex_tier]:
+        update_scrobble_matches(tier)
+    return matched_count
+
+
 def sqlite_conflict_hash(table, conn, keys, data_iter):
     from sqlalchemy.dialects.sqlite import insert
 
@@ -284,14 +681,94 @@ def sqlite_conflict_hash(table, conn, keys, data_iter):
     conn.execute(do_nothing_stmt)
 
 
-def scrobble_dataframe_to_db(df):
+def scrobble_fingerprints(df):
+    # 64-bit fingerprint of the lowercased "artist album track played_at" string, computed over whole columns.
+    # Missing values are spelled 'nan' as they were when scrobbles were keyed by md5 of the joined row.
+    key = df['artist'].fillna('nan').astype(str)
+    for column in ['album', 'track', 'played_at']:
+        key = key + ' ' + df[column].fillna('nan').astype(str)
+    return pd.util.hash_pandas_object(key.str.lower(), index=False).to_numpy().view(np.int64)
+
+
+def prepare_scrobble_dataframe(df):
     df['concat_lastfm'] = df['artist'].fillna('') + ' --- ' + df['album'].fillna('') + ' --- ' + df['track'].fillna('')
     df = df[['concat_lastfm', 'artist', 'album', 'track', 'played_at']]
     df = df.sort_values(by=['played_at']).reset_index(drop=True)
-    dicts = df[['artist', 'album', 'track', 'played_at']].to_dict('records')
-    dicts = [' '.join(map(str, d.values())).lower() for d in dicts]
-    df['hash'] = [hashlib.md5(str(x).encode('utf-8')).hexdigest() for x in dicts]
-    df = df.drop_duplicates(subset='hash')
+    df['hash'] = scrobble_fingerprints(df)
+    return df.drop_duplicates(subset='hash')
+
+
+def rehash_scrobbles(chunk_size=50000):
+    update_stmt = Scrobble.__table__.update().where(Scrobble.id == bindparam('b_id')).values(hash=bindparam('b_hash'))
+    row_count = 0
+    last_id = 0
+    while True:
+        query = (select(Scrobble.id, LastfmTrack.artist, LastfmTrack.album, LastfmTrack.track, Scrobble.played_at)
+                 .join(LastfmTrack, Scrobble.track_id == LastfmTrack.id)
+                 .where(Scrobble.id > last_id)
+                 .order_by(Scrobble.id)
+                 .limit(chunk_size))
+        df = pd.read_sql(query, con=db.session.connection())
+        if df.empty:
+            break
+        df['played_at'] = df['played_at'].map(str)
+        db.session.execute(update_stmt, [
+            {'b_id': int(scrobble_id), 'b_hash': int(fingerprint)}
+            for (scrobble_id, fingerprint) in zip(df['id'], scrobble_fingerprints(df))
+        ])
+        db.session.commit()
+        row_count += len(df)
+        last_id = int(df['id'].iloc[-1])
+    return row_count
+
+
+def lastfm_track_ids(concats, chunk_size=500):
+    track_ids = {}
+    for i in range(0, len(concats), chunk_size):
+        track_ids.update(db.session.query(LastfmTrack.concat_lastfm, LastfmTrack.id)
+                         .filter(LastfmTrack.concat_lastfm.in_(concats[i:i + chunk_size])))
+    return track_ids
+
+
+def normalize_scrobbles():
+    # One-off conversion of a scrobbles table that still carries concat_lastfm/artist/album/track/match_id:
+    # distinct tracks move to lastfm_tracks and scrobbles are rebuilt as (track_id, played_at, hash, status)
+    columns = [column['name'] for column in sqlalchemy_inspect(db.engine).get_columns('scrobbles')]
+    if 'track_id' in columns:
+        return 0
+    LastfmTrack.__table__.create(db.engine, checkfirst=True)
+    create_sql = str(CreateTable(Scrobble.__table__).compile(db.engine))
+    create_sql = create_sql.replace('CREATE TABLE scrobbles ', 'CREATE TABLE scrobbles_normalized ', 1)
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql('''INSERT OR IGNORE INTO lastfm_tracks (concat_lastfm, artist, album, track, match_id)
+                                SELECT concat_lastfm, MIN(artist), MIN(album), MIN(track), MAX(match_id)
+                                FROM scrobbles
+                                GROUP BY concat_lastfm
+                                ORDER BY MIN(id)''')
+        conn.exec_driver_sql(create_sql)
+        row_count = conn.exec_driver_sql('''INSERT INTO scrobbles_normalized (id, track_id, played_at, hash, status)
+                                           SELECT s.id, t.id, s.played_at, s.hash, s.status
+                                           FROM scrobbles s
+                                           JOIN lastfm_tracks t ON t.concat_lastfm = s.concat_lastfm''').rowcount
+        conn.exec_driver_sql('''DROP TABLE scrobbles''')
+        conn.exec_driver_sql('''ALTER TABLE scrobbles_normalized RENAME TO scrobbles''')
+        for index in Scrobble.__table__.indexes:
+            index.create(conn)
+    return row_count
+
+
+def insert_scrobble_dataframe(df):
+    # Each distinct artist/album/track is stored once in lastfm_tracks; scrobbles only carry its id
+    if df.empty:
+        return
+    tracks = df[['concat_lastfm', 'artist', 'album', 'track']].drop_duplicates(subset='concat_lastfm')
+    tracks['match_key'], tracks['artist_track_key'] = match_keys(tracks['artist'], tracks['album'], tracks['track'])
+    tracks = tracks.astype(object).where(tracks.notna(), None)
+    db.session.execute(sqlite_insert(LastfmTrack).on_conflict_do_nothing(index_elements=['concat_lastfm']),
+                       tracks.to_dict('records'))
+    db.session.commit()
+    track_ids = lastfm_track_ids(tracks['concat_lastfm'].tolist())
+    df = df.assign(track_id=df['concat_lastfm'].map(track_ids))[['track_id', 'played_at', 'hash']]
     with db.engine.connect() as conn:
         df.to_sql(
             'scrobbles',
@@ -300,100 +777,626 @@ def scrobble_dataframe_to_db(df):
             if_exists='append',
             method=sqlite_conflict_hash,
             index=False)
+    new_track_ids = [int(track_id) for track_id in df['track_id'].unique()]
+    match_ids = set()
+    for i in range(0, len(new_track_ids), 500):
+        match_ids.update(match_id for (match_id,) in (db.session.query(LastfmTrack.match_id)
+                                                      .filter(LastfmTrack.id.in_(new_track_ids[i:i + 500]),
+                                                              LastfmTrack.match_id != null())
+                                                      .distinct()))
+    if len(match_ids) > 0:
+        refresh_match_plays(match_ids)
+        db.session.commit()
+    return
+
+
+def scrobble_dataframe_to_db(df):
+    insert_scrobble_dataframe(prepare_scrobble_dataframe(df))
     return
 
 
+csv_progress = {'running': False, 'rows': 0}
+
+
+def import_scrobble_csv(stream, chunk_size=CSV_CHUNK_SIZE):
+    csv_progress.update(running=True, rows=0)
+    try:
+        for chunk in pd.read_csv(stream, encoding='utf8', chunksize=chunk_size):
+            df = chunk.rename(columns={'uts': 'played_at'}).filter(['played_at', 'artist', 'album', 'track'])
+            df['played_at'] = df['played_at'].map(str)
+            scrobble_dataframe_to_db(df)
+            csv_progress['rows'] += len(df)
+    finally:
+        csv_progress['running'] = False
+    return csv_progress['rows']
+
+
 """
 -------------------------- LAST.FM API ----------------------------
 """
 
 
-def get_lastfm(payload, api_key):
-    headers = {'user-agent': 'hex_lastfm_import/0.1; github.com/meisandrew'}
-    url = 'http://ws.audioscrobbler.com/2.0/'
+class TokenBucket:
+    # Shared rate limiter for Last.fm calls: `rate` tokens per second, bursting up to `capacity`
 
-    payload['api_key'] = api_key
-    payload['format'] = 'json'
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
 
-    response = requests.get(url, headers=headers, params=payload)
-    return response
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
 
-def pull_lastfm_data(lastfm_username, api_key, most_recent_uts):
-    responses = []
+lastfm_bucket = TokenBucket(rate=LASTFM_RATE_LIMIT, capacity=LASTFM_RATE_LIMIT)
 
-    page = 1
-    total_pages = 1
 
-    while page <= total_pages:
-        payload = {
-            'method': 'user.getRecentTracks',
-            'limit': 200,
-            'user': lastfm_username,
-            'page': page,
-            'from': most_recent_uts
-        }
+def lastfm_session():
+    retries = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=['GET'],
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=LASTFM_WORKERS, max_retries=retries)
+    session = requests.Session()
+    session.headers['user-agent'] = 'hex_lastfm_import/0.1; github.com/meisandrew'
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_lastfm(payload, api_key, session=None):
+    payload = dict(payload, api_key=api_key, format='json')
+    lastfm_bucket.acquire()
+    if session is None:
+        with lastfm_session() as session:
+            return session.get(app.config['LASTFM_API_URL'], params=payload)
+    return session.get(app.config['LASTFM_API_URL'], params=payload)
 
-        # make the API call
-        response = get_lastfm(payload, api_key)
 
-        # if we get an error, print the response and halt the loop
+def iter_lastfm_pages(payload, api_key, pages=None, ahead=LASTFM_WORKERS * 2):
+    # Yields (page, total_pages, parsed JSON) in page order and stops at the first page that failed.
+    # Without an explicit page list, page 1 is fetched first to learn totalPages. Up to `ahead` later pages are
+    # fetched concurrently while the consumer works; anything still queued is cancelled if iteration stops early.
+    def fetch(page):
+        response = get_lastfm(dict(payload, page=page), api_key, session)
         if response.status_code != 200:
             print(response.text)
+            return None
+        return response.json()
+
+    with lastfm_session() as session:
+        if pages is None:
+            first = fetch(1)
+            if first is None:
+                return
+            total_pages = int(first['recenttracks']['@attr']['totalPages'])
+            yield 1, total_pages, first
+            pages = range(2, total_pages + 1)
+        pages = iter(pages)
+        window = deque()
+        with ThreadPoolExecutor(max_workers=LASTFM_WORKERS) as executor:
+            try:
+                while True:
+                    for page in islice(pages, max(ahead, 1) - len(window)):
+                        window.append((page, executor.submit(fetch, page)))
+                    if len(window) == 0:
+                        return
+                    page, future = window.popleft()
+                    result = future.result()
+                    if result is None:
+                        return
+                    for next_page in islice(pages, ahead - len(window)):
+                        window.append((next_page, executor.submit(fetch, next_page)))
+                    yield page, int(result['recenttracks']['@attr']['totalPages']), result
+            finally:
+                for (_, pending) in window:
+                    pending.cancel()
+
+
+def lastfm_page_dataframe(result):
+    df = pd.json_normalize(result['recenttracks']['track'])
+    df = df.filter(['artist.#text', 'album.#text', 'date.uts', 'name'])
+    df = df.rename(columns={'artist.#text': 'artist', 'album.#text': 'album', 'date.uts': 'played_at', 'name': 'track'})
+    df = df.dropna()
+    try:
+        return df[['played_at', 'artist', 'album', 'track']].reset_index(drop=True)
+    except KeyError:
+        return pd.DataFrame([])
+
+
+def ingest_lastfm_data(account):
+    # Each page is inserted as soon as it arrives. lastfm_sync_to records the oldest play stored so far, so an
+    # interrupted backfill resumes from that point with the same lower bound instead of starting over.
+    # Routine syncs start LASTFM_SYNC_OVERLAP seconds before the newest stored play to pick up late scrobbles,
+    # and stop at the first page whose scrobbles are all stored already.
+    if account.lastfm_sync_to is None:
+        most_recent_uts = db.session.query(func.max(Scrobble.played_at)).scalar()
+        account.lastfm_sync_from = None if most_recent_uts is None else int(most_recent_uts) - LASTFM_SYNC_OVERLAP
+        db.session.commit()
+    payload = {
+        'method': 'user.getRecentTracks',
+        'limit': 200,
+        'user': account.lastfm_username,
+        'from': account.lastfm_sync_from,
+        'to': account.lastfm_sync_to
+    }
+    row_count = 0
+    page, total_pages = 0, 1
+    for (page, total_pages, result) in iter_lastfm_pages(payload, account.lastfm_api_key):
+        df = lastfm_page_dataframe(result)
+        if df.empty:
+            continue
+        df = prepare_scrobble_dataframe(df)
+        stored = set(scrobble_hash for (scrobble_hash,) in
+                     db.session.query(Scrobble.hash).filter(Scrobble.hash.in_(df['hash'].tolist())))
+        df_new = df[~df['hash'].isin(stored)]
+        if df_new.empty:
+            page = total_pages
             break
+        insert_scrobble_dataframe(df_new)
+        row_count += len(df_new)
+        account.lastfm_sync_to = int(df['played_at'].astype(int).min()) + 1
+        db.session.commit()
+    if page >= total_pages:
+        account.lastfm_sync_from, account.lastfm_sync_to = None, None
+        db.session.commit()
+    return row_count
 
-        # extract pagination info
-        page = int(response.json()['recenttracks']['@attr']['page'])
-        total_pages = int(response.json()['recenttracks']['@attr']['totalPages'])
 
-        # append response
-        responses.append(response)
+"""
+-------------------------- FUZZY MATCHING ----------------------------
+"""
 
-        # sleep
-        time.sleep(0.25)
 
-        # increment the page number
-        page += 1
+def trigrams(s):
+    grams = set()
+    for token in utils.full_process(s or '').split():
+        padded = f'  {token} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
 
-    if total_pages <= 3:
-        page = total_pages
-        total_pages = 4
-        while page <= total_pages:
-            payload = {
-                'method': 'user.getRecentTracks',
-                'limit': 200,
-                'user': lastfm_username,
-                'page': page
-            }
 
-            # make the API call
-            response = get_lastfm(payload, api_key)
+class PlexTrigramIndex:
+    # Inverted trigram index over Plex.concat_plex, used to shortlist candidates before fuzzy scoring.
+    # Base postings are numpy arrays built in one pass; later library changes are patched into an overlay
+    # and the affected ids are masked out of the base until the next full rebuild.
 
-            # if we get an error, print the response and halt the loop
-            if response.status_code != 200:
-                print(response.text)
-                break
+    def __init__(self, shortlist=300, overlay_limit=0.1):
+        self.shortlist = shortlist
+        self.overlay_limit = overlay_limit
+        self.lock = threading.Lock()
+        self.built = False
+        self.choices = {}
+        self.gram_lookup = {}
+        self.postings = []
+        self.stale = np.zeros(0, dtype=bool)
+        self.overlay = {}
+        self.overlay_grams = {}
 
-            # append response
-            responses.append(response)
+    def build(self, rows=None):
+        if rows is None:
+            rows = db.session.query(Plex.id, Plex.concat_plex).filter(Plex.concat_plex != null()).all()
+        gram_lookup = {}
+        gram_ids, plex_ids = [], []
+        for (plex_id, concat_plex) in rows:
+            for gram in trigrams(concat_plex):
+                gram_ids.append(gram_lookup.setdefault(gram, len(gram_lookup)))
+                plex_ids.append(plex_id)
+        gram_ids = np.array(gram_ids, dtype=np.int64)
+        plex_ids = np.array(plex_ids, dtype=np.int64)
+        order = np.argsort(gram_ids, kind='stable')
+        splits = np.cumsum(np.bincount(gram_ids, minlength=len(gram_lookup)))[:-1]
+        self.choices = dict(rows)
+        self.gram_lookup = gram_lookup
+        self.postings = np.split(plex_ids[order], splits) if len(gram_lookup) > 0 else []
+        self.stale = np.zeros(max(self.choices, default=0) + 1, dtype=bool)
+        self.overlay = {}
+        self.overlay_grams = {}
+        self.built = True
 
-            # sleep
-            time.sleep(0.25)
+    def _drop_overlay(self, plex_id):
+        for gram in self.overlay_grams.pop(plex_id, ()):
+            self.overlay[gram].discard(plex_id)
 
-            # increment the page number
-            page += 1
+    def sync(self):
+        with self.lock:
+            if not self.built:
+                return
+            rows = dict(db.session.query(Plex.id, Plex.concat_plex).filter(Plex.concat_plex != null()).all())
+            removed = [plex_id for plex_id in self.choices if plex_id not in rows]
+            changed = [plex_id for (plex_id, concat_plex) in rows.items() if self.choices.get(plex_id) != concat_plex]
+            if len(removed) + len(changed) == 0:
+                return
+            if len(self.overlay_grams) + len(changed) > self.overlay_limit * max(len(rows), 1):
+                self.build()
+                return
+            if len(rows) > 0 and max(rows) >= len(self.stale):
+                self.stale = np.concatenate([self.stale, np.zeros(max(rows) + 1 - len(self.stale), dtype=bool)])
+            for plex_id in removed + changed:
+                self.stale[plex_id] = True
+                self._drop_overlay(plex_id)
+                self.choices.pop(plex_id, None)
+            for plex_id in changed:
+                grams = trigrams(rows[plex_id])
+                for gram in grams:
+                    self.overlay.setdefault(gram, set()).add(plex_id)
+                self.overlay_grams[plex_id] = grams
+                self.choices[plex_id] = rows[plex_id]
 
-    frames = [pd.DataFrame(pd.json_normalize(r.json()['recenttracks']['track'])) for r in responses]
-    df_lastfm_pull = pd.concat(frames).filter(['artist.#text', 'album.#text', 'date.uts', 'name'])
-    df_lastfm_pull = df_lastfm_pull.rename(columns={'artist.#text': 'artist', 'album.#text': 'album', 'date.uts': 'played_at', 'name': 'track'})
-    df_lastfm_pull = df_lastfm_pull.reset_index(drop=True)
-    df_lastfm_pull = df_lastfm_pull.dropna()
-    if df_lastfm_pull.empty:
-        return pd.DataFrame([])
+    def candidates(self, query):
+        grams = trigrams(query)
+        base = [self.postings[self.gram_lookup[gram]] for gram in grams if gram in self.gram_lookup]
+        counts = np.zeros(len(self.stale), dtype=np.int64)
+        if len(base) > 0:
+            counts += np.bincount(np.concatenate(base), minlength=len(self.stale))
+        counts[self.stale] = 0
+        for gram in grams:
+            for plex_id in self.overlay.get(gram, ()):
+                counts[plex_id] += 1
+        hits = np.flatnonzero(counts)
+        if len(hits) > self.shortlist:
+            hits = hits[np.argpartition(counts[hits], -self.shortlist)[-self.shortlist:]]
+        return {int(plex_id): self.choices[int(plex_id)] for plex_id in hits}
+
+    def suggestions(self, query, limit=5, score_cutoff=SUGGESTION_CUTOFF):
+        with self.lock:
+            if not self.built:
+                self.build()
+            shortlist = self.candidates(query)
+        results = process.extract(query, shortlist, scorer=fuzz.token_sort_ratio, limit=limit)
+        return [{'concatPlex': str(a), 'id': int(c), 'score': b} for (a, b, c) in results if b >= score_cutoff]
+
+
+plex_index = PlexTrigramIndex()
+
+
+suggestion_lock = threading.Lock()
+suggestion_generation = 0
+
+
+def store_suggestions(rows):
+    insert_stmt = sqlite_insert(Suggestion).on_conflict_do_update(
+        index_elements=['concat_lastfm'],
+        set_={'suggestions': sqlite_insert(Suggestion).excluded.suggestions}
+    )
+    db.session.execute(insert_stmt, [
+        {'concat_lastfm': concat_lastfm, 'suggestions': json.dumps(suggestions)}
+        for (concat_lastfm, suggestions) in rows
+    ])
+    db.session.commit()
+    return
+
+
+def get_suggestions(concat_lastfm):
+    row = db.session.query(Suggestion).filter(Suggestion.concat_lastfm == concat_lastfm).first()
+    if row is not None:
+        return json.loads(row.suggestions)
+    suggestions = plex_index.suggestions(concat_lastfm, limit=SUGGESTION_LIMIT)
+    store_suggestions([(concat_lastfm, suggestions)])
+    return suggestions
+
+
+def fill_suggestion_queue(batch_size=200):
+    generation = suggestion_generation
+    unreviewed = select(LastfmTrack.concat_lastfm).filter(LastfmTrack.match_id == null())
+    db.session.query(Suggestion).filter(Suggestion.concat_lastfm.not_in(unreviewed)).delete()
+    db.session.commit()
+    pending = [concat_lastfm for (concat_lastfm,) in
+               (db.session.query(LastfmTrack.concat_lastfm)
+                .join(Scrobble, LastfmTrack.id == Scrobble.track_id)
+                .outerjoin(Suggestion, LastfmTrack.concat_lastfm == Suggestion.concat_lastfm)
+                .filter(LastfmTrack.match_id == null(), Suggestion.id == null())
+                .group_by(LastfmTrack.id)
+                .order_by(func.min(Scrobble.id))
+                .all())]
+    for i in range(0, len(pending), batch_size):
+        rows = [(concat_lastfm, plex_index.suggestions(concat_lastfm, limit=SUGGESTION_LIMIT))
+                for concat_lastfm in pending[i:i + batch_size]]
+        # Drop the batch if the library changed while it was being scored
+        if generation != suggestion_generation:
+            return
+        store_suggestions(rows)
+    return
+
+
+def run_suggestion_fill():
+    if not suggestion_lock.acquire(blocking=False):
+        return
+    try:
+        with app.app_context():
+            fill_suggestion_queue()
+    finally:
+        suggestion_lock.release()
+    return
+
+
+def start_suggestion_fill():
+    threading.Thread(target=run_suggestion_fill, daemon=True).start()
+    return
+
+
+def top_up_suggestions():
+    # Reads only start a fill once the queue runs low and something is missing from it; uploads, syncs and unmatches
+    # start their own fill after invalidating
+    if db.session.query(func.count(Suggestion.id)).scalar() >= SUGGESTION_LOW_WATER:
+        return
+    missing = (db.session.query(LastfmTrack.id)
+               .outerjoin(Suggestion, LastfmTrack.concat_lastfm == Suggestion.concat_lastfm)
+               .filter(LastfmTrack.match_id == null(), Suggestion.id == null(), LastfmTrack.scrobbles.any())
+               .first())
+    if missing is not None:
+        start_suggestion_fill()
+    return
+
+
+def clear_suggestions(concat_lastfm=None):
+    global suggestion_generation
+    query = db.session.query(Suggestion)
+    if concat_lastfm is None:
+        suggestion_generation += 1
     else:
-        try:
-            df_lastfm_pull = df_lastfm_pull[['played_at', 'artist', 'album', 'track']]
-        except KeyError:
-            return pd.DataFrame([])
+        query = query.filter(Suggestion.concat_lastfm == concat_lastfm)
+    query.delete()
+    return
+
+
+def invalidate_suggestions(rating_keys, chunk_size=500):
+    # Drops only the stored suggestions a library change can alter: lists naming a changed or removed Plex track, and
+    # lists a changed or added track would now enter. rating_keys are the changed and added tracks; the reverse index
+    # over the stored concat_lastfm values scores just those, like propose_matches.
+    global suggestion_generation
+    suggestion_generation += 1
+    rating_keys = [int(rating_key) for rating_key in rating_keys]
+    changed = []
+    for i in range(0, len(rating_keys), chunk_size):
+        changed += (db.session.query(Plex.id, Plex.concat_plex)
+                    .filter(Plex.rating_key.in_(rating_keys[i:i + chunk_size]), Plex.concat_plex != null())
+                    .all())
+    stored = [(suggestion_id, concat_lastfm, json.loads(suggestions)) for (suggestion_id, concat_lastfm, suggestions)
+              in db.session.query(Suggestion.id, Suggestion.concat_lastfm, Suggestion.suggestions)]
+    referenced = list(set(suggestion['id'] for (_, _, suggestions) in stored for suggestion in suggestions))
+    live = set()
+    for i in range(0, len(referenced), chunk_size):
+        live.update(plex_id for (plex_id,) in
+                    db.session.query(Plex.id).filter(Plex.id.in_(referenced[i:i + chunk_size])))
+    live.difference_update(plex_id for (plex_id, _) in changed)
+    stale = set()
+    weakest = {}
+    for (suggestion_id, concat_lastfm, suggestions) in stored:
+        if any(suggestion['id'] not in live for suggestion in suggestions):
+            stale.add(suggestion_id)
         else:
-            return df_lastfm_pull
+            # A list that is not full takes any track over the cutoff
+            weakest[suggestion_id] = (suggestions[-1]['score'] if len(suggestions) >= SUGGESTION_LIMIT
+                                      else SUGGESTION_CUTOFF)
+    if len(changed) > 0 and len(weakest) > 0:
+        stored_index = PlexTrigramIndex()
+        stored_index.build([(suggestion_id, concat_lastfm) for (suggestion_id, concat_lastfm, _) in stored
+                            if suggestion_id in weakest])
+        for (_, concat_plex) in changed:
+            stale.update(best['id'] for best in stored_index.suggestions(concat_plex, limit=None)
+                         if best['score'] >= weakest[best['id']])
+    stale = list(stale)
+    for i in range(0, len(stale), chunk_size):
+        (db.session.query(Suggestion)
+         .filter(Suggestion.id.in_(stale[i:i + chunk_size]))
+         .delete(synchronize_session=False))
+    return len(stale)
+
+
+def propose_matches(rating_keys, chunk_size=500):
+    # Reverse matching for newly added tracks: the trigram index is built over the unmatched backlog
+    # (ids and strings are Match.id and concat_lastfm) and queried with each new concat_plex, so only
+    # the new tracks are scored.
+    unmatched = select(Match.id).where(Match.plex_id == 0)
+    (db.session.query(MatchProposal)
+     .filter(or_(MatchProposal.match_id.not_in(unmatched), MatchProposal.plex_id.not_in(select(Plex.id))))
+     .delete(synchronize_session=False))
+    backlog = db.session.query(Match.id, Match.concat_lastfm).filter(Match.plex_id == 0).all()
+    rating_keys = [int(rating_key) for rating_key in rating_keys]
+    if len(backlog) == 0 or len(rating_keys) == 0:
+        db.session.commit()
+        return 0
+    added = []
+    for i in range(0, len(rating_keys), chunk_size):
+        added += (db.session.query(Plex.id, Plex.concat_plex)
+                  .filter(Plex.rating_key.in_(rating_keys[i:i + chunk_size]), Plex.concat_plex != null())
+                  .all())
+    backlog_index = PlexTrigramIndex()
+    backlog_index.build(backlog)
+    proposals = [
+        {'match_id': best['id'], 'plex_id': plex_id, 'score': best['score']}
+        for (plex_id, concat_plex) in added
+        for best in backlog_index.suggestions(concat_plex, limit=PROPOSAL_LIMIT, score_cutoff=PROPOSAL_THRESHOLD)
+    ]
+    if len(proposals) > 0:
+        db.session.execute(
+            sqlite_insert(MatchProposal).on_conflict_do_nothing(index_elements=['match_id', 'plex_id']), proposals)
+    db.session.commit()
+    return len(proposals)
+
+
+sweep_lock = threading.Lock()
+sweep_progress = {'running': False, 'done': 0, 'total': 0}
+sweep_index = None
+
+
+def sweep_worker_init(rows):
+    global sweep_index
+    sweep_index = PlexTrigramIndex()
+    sweep_index.build(rows)
+    return
+
+
+def sweep_worker_score(chunk):
+    results = []
+    for concat_lastfm in chunk:
+        # Every candidate sharing the best score is kept, so a tie can be told apart from a clear winner
+        top = sweep_index.suggestions(concat_lastfm, limit=PROPOSAL_LIMIT, score_cutoff=0)
+        results.append((concat_lastfm, [candidate for candidate in top if candidate['score'] == top[0]['score']]))
+    return results
+
+
+def auto_resolve_sweep(threshold=AUTO_RESOLVE_THRESHOLD, dry_run=True, workers=None, chunk_size=200):
+    if not sweep_lock.acquire(blocking=False):
+        return None
+    try:
+        unreviewed = (db.session.query(LastfmTrack.concat_lastfm, func.count(Scrobble.id))
+                      .join(Scrobble, LastfmTrack.id == Scrobble.track_id)
+                      .filter(LastfmTrack.match_id == null())
+                      .group_by(LastfmTrack.id)
+                      .all())
+        scrobble_counts = dict(unreviewed)
+        pending = list(scrobble_counts)
+        rows = db.session.query(Plex.id, Plex.concat_plex).filter(Plex.concat_plex != null()).all()
+        sweep_progress.update(running=True, done=0, total=len(pending))
+        scored = []
+        if len(pending) > 0 and len(rows) > 0:
+            chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+            # Spawned rather than forked: a fork of the threaded server would copy held locks and open
+            # SQLAlchemy/sqlite connections into the workers, which only ever see the rows passed to their initializer
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=sweep_worker_init,
+                                     initargs=([tuple(row) for row in rows],)) as executor:
+                futures = [executor.submit(sweep_worker_score, chunk) for chunk in chunks]
+                for future in as_completed(futures):
+                    results = future.result()
+                    scored.extend(results)
+                    sweep_progress['done'] += len(results)
+        resolved = sorted(
+            [{'concatLastfm': concat_lastfm, 'concatPlex': top[0]['concatPlex'], 'plexId': top[0]['id'],
+              'score': top[0]['score'], 'scrobbleCount': scrobble_counts[concat_lastfm]}
+             for (concat_lastfm, top) in scored if len(top) == 1 and top[0]['score'] >= threshold],
+            key=lambda row: (-row['score'], row['concatLastfm']))
+        # Several Plex tracks sharing the top score stay unreviewed, with the tied tracks stored as their suggestions
+        tied = sorted(
+            [{'concatLastfm': concat_lastfm, 'candidates': top, 'score': top[0]['score'],
+              'scrobbleCount': scrobble_counts[concat_lastfm]}
+             for (concat_lastfm, top) in scored if len(top) > 1 and top[0]['score'] >= threshold],
+            key=lambda row: (-row['score'], row['concatLastfm']))
+        histogram = np.bincount([top[0]['score'] // 10 if len(top) > 0 else 0 for (_, top) in scored],
+                                minlength=11).tolist()
+        if not dry_run:
+            resolved_keys = set(match.lower() for (match,) in db.session.query(Match.concat_lastfm))
+            new_matches = {}
+            for row in resolved:
+                key = row['concatLastfm'].lower()
+                if key not in resolved_keys:
+                    new_matches.setdefault(key, {'concat_lastfm': row['concatLastfm'], 'plex_id': row['plexId']})
+            created = insert_matches(list(new_matches.values())) if len(new_matches) > 0 else {}
+            update_scrobble_matches([
+                {'b_concat_lastfm': row['concatLastfm'], 'b_match_id': created[row['concatLastfm'].lower()],
+                 'b_status': 'matched'}
+                for row in resolved if row['concatLastfm'].lower() in created
+            ])
+            if len(tied) > 0:
+                store_suggestions([(row['concatLastfm'], row['candidates']) for row in tied])
+            db.session.commit()
+        return {
+            'dryRun': dry_run,
+            'threshold': threshold,
+            'scoredCount': len(scored),
+            'resolvedCount': len(resolved),
+            'resolvedScrobbleCount': sum(row['scrobbleCount'] for row in resolved),
+            'tiedCount': len(tied),
+            'scoreHistogram': histogram,
+            'resolved': resolved,
+            'tied': tied
+        }
+    finally:
+        sweep_progress['running'] = False
+        sweep_lock.release()
+
+
+"""
+-------------------------- SEARCH INDEX ----------------------------
+"""
+
+
+# External-content trigram FTS5 tables, kept in step with their source tables by triggers
+SEARCH_INDEXES = {'plex_tracks_fts': ('plex_tracks', 'concat_plex'), 'matches_fts': ('matches', 'concat_lastfm')}
+SEARCH_INDEX_DDL = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({column}, content='{table}', content_rowid='id',
+       tokenize='trigram')''',
+    '''CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+       INSERT INTO {fts} (rowid, {column}) VALUES (new.id, new.{column});
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+       INSERT INTO {fts} ({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {column} ON {table} BEGIN
+       INSERT INTO {fts} ({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+       INSERT INTO {fts} (rowid, {column}) VALUES (new.id, new.{column});
+       END'''
+]
+
+
+SEARCH_INDEX_SHADOW_TABLES = ['data', 'idx', 'docsize', 'config']
+SEARCH_INDEX_TRIGGERS = ['ai', 'ad', 'au']
+
+
+def ensure_search_index():
+    # Created on first search. An index missing its virtual table, a shadow table or a trigger is dropped and rebuilt
+    # from its table, since triggers writing to a broken index would make every insert into the table fail
+    with db.engine.begin() as conn:
+        for (fts, (table, column)) in SEARCH_INDEXES.items():
+            tables = [fts] + [f'{fts}_{suffix}' for suffix in SEARCH_INDEX_SHADOW_TABLES]
+            triggers = [f'{fts}_{suffix}' for suffix in SEARCH_INDEX_TRIGGERS]
+            found = conn.exec_driver_sql(
+                f"SELECT count(*) FROM sqlite_master WHERE name IN ({', '.join('?' * (len(tables) + len(triggers)))})",
+                tuple(tables + triggers)
+            ).scalar()
+            if found == len(tables) + len(triggers):
+                continue
+            for trigger in triggers:
+                conn.exec_driver_sql(f'DROP TRIGGER IF EXISTS {trigger}')
+            if conn.exec_driver_sql('SELECT count(*) FROM sqlite_master WHERE name = ?', (fts,)).scalar() > 0:
+                # FTS5 cannot drop a table whose shadow tables are gone, so they are first restored from a scratch index
+                repair = f'{fts}_repair'
+                conn.exec_driver_sql(SEARCH_INDEX_DDL[0].format(fts=repair, table=table, column=column))
+                for suffix in SEARCH_INDEX_SHADOW_TABLES:
+                    ddl = conn.exec_driver_sql('SELECT sql FROM sqlite_master WHERE name = ?',
+                                               (f'{repair}_{suffix}',)).scalar()
+                    conn.exec_driver_sql(ddl.replace(f"'{repair}_{suffix}'", f"IF NOT EXISTS '{fts}_{suffix}'"))
+                conn.exec_driver_sql(f'INSERT OR IGNORE INTO {fts}_data SELECT * FROM {repair}_data')
+                conn.exec_driver_sql(f'INSERT OR IGNORE INTO {fts}_config SELECT * FROM {repair}_config')
+                conn.exec_driver_sql(f'DROP TABLE {repair}')
+            for name in tables:
+                conn.exec_driver_sql(f'DROP TABLE IF EXISTS {name}')
+            for ddl in SEARCH_INDEX_DDL:
+                conn.exec_driver_sql(ddl.format(fts=fts, table=table, column=column))
+            conn.exec_driver_sql(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+    return
+
+
+def search_terms(filter_str):
+    # Terms of three or more characters can use the trigram index, shorter ones fall back to LIKE
+    terms = filter_str.split()
+    fts_query = ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms if len(term) >= 3)
+    like_terms = ['%{}%'.format(term) for term in terms if len(term) < 3]
+    return fts_query, like_terms
+
+
+def search_index_matches(fts, fts_query, limit=None):
+    # (rowid, bm25 rank) of the rows containing every term, best first; a limit keeps the best-ranked rows
+    fts_table = sqlalchemy_table(fts, sqlalchemy_column('rowid'), sqlalchemy_column('rank'))
+    return (select(fts_table.c.rowid, fts_table.c.rank)
+            .where(literal_column(fts).op('MATCH')(fts_query))
+            .order_by(fts_table.c.rank)
+            .limit(limit)
+            .subquery())
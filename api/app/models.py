@@ -23,6 +23,10 @@ class Account(db.Model):
     plex_device_id = db.Column(db.Integer)
     plex_music_library_id = db.Column(db.Integer)
     last_hex_update = db.Column(db.DateTime)
+    last_plex_update = db.Column(db.DateTime)
+    lastfm_sync_from = db.Column(db.Integer)
+    lastfm_sync_to = db.Column(db.Integer)
+    plex_sync_watermark = db.Column(db.Integer)
 
     def __repr__(self):
         return f'<Account: {self.id} {self.lastfm_username}>'
@@ -34,38 +38,34 @@ class AddedTrack(db.Model):
     rating_key = db.Column(db.Integer)
 
 
-class Scrobble(db.Model):
-    __tablename__ = 'scrobbles'
+class LastfmTrack(db.Model):
+    __tablename__ = 'lastfm_tracks'
     id = db.Column(db.Integer, primary_key=True)
     concat_lastfm = db.Column(db.String, index=True)
-    artist = db.Column(db.String, index=True)
-    album = db.Column(db.String, index=True)
-    track = db.Column(db.String, index=True)
-    played_at = db.Column(db.Integer)
-    hash = db.Column(db.String)
+    artist = db.Column(db.String)
+    album = db.Column(db.String)
+    track = db.Column(db.String)
     match_id = db.Column(db.Integer, db.ForeignKey('matches.id'), index=True)
+    match_key = db.Column(db.String, index=True)
+    artist_track_key = db.Column(db.String, index=True)
+    scrobbles = db.relationship('Scrobble', backref='lastfm_track', lazy='dynamic')
+    __table_args__ = (db.UniqueConstraint('concat_lastfm', name='_lastfm_track_concat_uc'),)
+
+    def __repr__(self):
+        return f'<Last.fm Track: {self.concat_lastfm}>'
+
+
+class Scrobble(db.Model):
+    __tablename__ = 'scrobbles'
+    id = db.Column(db.Integer, primary_key=True)
+    track_id = db.Column(db.Integer, db.ForeignKey('lastfm_tracks.id'), index=True)
+    played_at = db.Column(db.Integer, index=True)
+    hash = db.Column(db.Integer)
     status = db.Column(db.String)
     __table_args__ = (db.UniqueConstraint('hash', name='_hash_uc'),)
 
-    def processing_data(self):
-        account = db.session.query(Account).first()
-        return {
-            'account_id': account.plex_account_id,
-            'guid': self.match.plex_track.guid,
-            'metadata_type': 10,
-            'library_section_id': account.plex_music_library_id,
-            'grandparent_title': self.match.plex_track.artist,
-            'parent_index': self.match.plex_track.parent_index,
-            'parent_title': self.match.plex_track.album,
-            'index': self.match.plex_track.track_index,
-            'title': self.match.plex_track.track,
-            'viewed_at': self.played_at,
-            'grandparent_guid': self.match.plex_track.grandparent_guid,
-            'device_id': account.plex_device_id
-        }
-
     def __repr__(self):
-        return f'<Scrobble: {self.concat_lastfm} {self.played_at}>'
+        return f'<Scrobble: {self.track_id} {self.played_at}>'
 
 
 class Match(db.Model):
@@ -73,7 +73,9 @@ class Match(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     concat_lastfm = db.Column(db.String, index=True)
     plex_id = db.Column(db.Integer, db.ForeignKey('plex_tracks.id'), index=True)
-    scrobbles = db.relationship('Scrobble', backref='match', lazy='dynamic')
+    tracks = db.relationship('LastfmTrack', backref='match', lazy='dynamic')
+    plays = db.relationship('MatchPlay', backref='match', lazy='dynamic')
+    scrobbles = db.relationship('Scrobble', secondary='lastfm_tracks', viewonly=True)
     __table_args__ = (db.UniqueConstraint('concat_lastfm', name='_concat_lastfm_uc'),)
 
     def __repr__(self):
@@ -94,6 +96,9 @@ class Plex(db.Model):
     track = db.Column(db.String)
     track_index = db.Column(db.Integer)
     guid = db.Column(db.String, index=True)
+    fingerprint = db.Column(db.Integer)
+    match_key = db.Column(db.String, index=True)
+    artist_track_key = db.Column(db.String, index=True)
     match = db.relationship('Match', backref='plex_track', lazy='dynamic')
     __table_args__ = (db.UniqueConstraint('rating_key', name='_rating_key_uc'),)
 
@@ -101,6 +106,65 @@ class Plex(db.Model):
         return f'<Plex Track: {self.concat_plex}>'
 
 
+class PlexWrite(db.Model):
+    __tablename__ = 'plex_writes'
+    id = db.Column(db.Integer, primary_key=True)
+    scrobble_id = db.Column(db.Integer, db.ForeignKey('scrobbles.id'), index=True)
+    view_id = db.Column(db.Integer)
+    guid = db.Column(db.String)
+    parent_guid = db.Column(db.String)
+    grandparent_guid = db.Column(db.String)
+
+    def __repr__(self):
+        return f'<Plex Write: {self.scrobble_id} {self.view_id}>'
+
+
+class Suggestion(db.Model):
+    __tablename__ = 'suggestions'
+    id = db.Column(db.Integer, primary_key=True)
+    concat_lastfm = db.Column(db.String)
+    suggestions = db.Column(db.String)
+    __table_args__ = (db.UniqueConstraint('concat_lastfm', name='_suggestion_concat_lastfm_uc'),)
+
+    def __repr__(self):
+        return f'<Suggestion: {self.concat_lastfm}>'
+
+
+class MatchProposal(db.Model):
+    __tablename__ = 'match_proposals'
+    id = db.Column(db.Integer, primary_key=True)
+    match_id = db.Column(db.Integer, db.ForeignKey('matches.id'), index=True)
+    plex_id = db.Column(db.Integer, db.ForeignKey('plex_tracks.id'), index=True)
+    score = db.Column(db.Integer)
+    __table_args__ = (db.UniqueConstraint('match_id', 'plex_id', name='_match_proposal_uc'),)
+
+    def __repr__(self):
+        return f'<Match Proposal: {self.match_id} {self.plex_id} {self.score}>'
+
+
+class MatchPlay(db.Model):
+    __tablename__ = 'match_plays'
+    id = db.Column(db.Integer, primary_key=True)
+    match_id = db.Column(db.Integer, db.ForeignKey('matches.id'), index=True)
+    day = db.Column(db.Integer, index=True)
+    plays = db.Column(db.Integer)
+    __table_args__ = (db.UniqueConstraint('match_id', 'day', name='_match_play_day_uc'),)
+
+    def __repr__(self):
+        return f'<Match Play: {self.match_id} {self.day} {self.plays}>'
+
+
+class Generation(db.Model):
+    __tablename__ = 'generations'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String)
+    value = db.Column(db.Integer)
+    __table_args__ = (db.UniqueConstraint('name', name='_generation_name_uc'),)
+
+    def __repr__(self):
+        return f'<Generation: {self.name} {self.value}>'
+
+
 class AccountSchema(ma.SQLAlchemySchema, CamelCaseSchema):
     class Meta:
         model = Account
@@ -137,13 +201,14 @@ class ScrobbleSchema(ma.SQLAlchemySchema, CamelCaseSchema):
         model = Scrobble
 
     id = ma.auto_field()
-    concat_lastfm = ma.auto_field()
-    artist = ma.auto_field()
-    album = ma.auto_field()
-    track = ma.auto_field()
+    concat_lastfm = ma.String(attribute='lastfm_track.concat_lastfm')
+    artist = ma.String(attribute='lastfm_track.artist')
+    album = ma.String(attribute='lastfm_track.album')
+    track = ma.String(attribute='lastfm_track.track')
     played_at = ma.auto_field()
-    hash = ma.auto_field()
-    match_id = ma.auto_field()
+    # Serialized as a string: signed 64-bit fingerprints do not survive as JSON numbers in JavaScript
+    hash = ma.String()
+    match_id = ma.Integer(attribute='lastfm_track.match_id')
     status = ma.auto_field()
 
 
@@ -153,5 +218,5 @@ class MatchSchema(ma.SQLAlchemySchema, CamelCaseSchema):
 
     id = ma.auto_field()
     concat_lastfm = ma.auto_field()
-    scrobbles = ma.auto_field()
+    scrobbles = ma.Pluck('ScrobbleSchema', 'id', many=True)
     plex_track = ma.Nested(PlexSchema)
@@ -1,17 +1,23 @@
+import functools
+import gzip
 import json
 import numpy as np
-import pandas as pd
 import sqlalchemy
 import sqlite3
 import time
 import uuid
 from app import app, db
-from app.models import Account, AccountSchema, AddedTrack, Match, MatchSchema, Plex, PlexSchema, Scrobble, ScrobbleSchema
+from app.models import (Account, AccountSchema, AddedTrack, LastfmTrack, Match, MatchProposal, MatchSchema,
+                        Plex, PlexSchema, Scrobble, ScrobbleSchema)
 from datetime import datetime
 from flask import jsonify, request, make_response
-from fuzzywuzzy import process, fuzz
-from sqlalchemy import select
-from sqlalchemy.sql import and_, or_, asc, desc, func
+from sqlalchemy import case, select
+from sqlalchemy.sql import and_, asc, desc, func
+
+
+GZIP_MIN_SIZE = 1024
+# Part of every ETag; bump it when a tagged response changes shape so clients drop what they cached
+ETAG_VERSION = 1
 
 
 @app.route("/")
@@ -25,6 +31,62 @@ def jsonify_no_content():
     return response
 
 
+def bumps_generations(*names, methods=None):
+    # Bumped once the view has run, also when it fails part-way through, so no cached read outlives a write
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            from app.functions import bump_generations
+            if methods is not None and request.method not in methods:
+                return view(*args, **kwargs)
+            try:
+                return view(*args, **kwargs)
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                bump_generations(*names)
+        return wrapper
+    return decorator
+
+
+def conditional_get(*names):
+    # Tags a read endpoint with the generations of the data it returns; a client that still holds that version gets
+    # a 304 without the view running
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            from app.functions import get_generations, get_instance_token
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+            # Built from stored values only, so every worker and restart hands out the same tag for the same data
+            etag = '-'.join(str(part) for part in (ETAG_VERSION, get_instance_token(), *get_generations(list(names))))
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+            response.set_etag(etag, weak=True)
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+@app.after_request
+def compress_response(response):
+    # Whether a body is compressed depends on Accept-Encoding, so caches must key on it for every response
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or response.direct_passthrough or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers or 'gzip' not in request.accept_encodings):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
 def create_device(database_path):
     name = 'hex-last.fm-import'
     identifier = uuid.uuid4()
@@ -53,6 +115,8 @@ def populate_account_fields(account, form_data):
 
 
 @app.route("/api/account_info", methods=['GET', 'POST'])
+@bumps_generations('accounts', methods=['POST'])
+@conditional_get('accounts')
 def account_info():
     schema = AccountSchema()
     account = db.session.query(Account).first()
@@ -84,23 +148,55 @@ def sqlite_conflict_hash(table, conn, keys, data_iter):
     conn.execute(do_nothing_stmt)
 
 
+@app.route("/api/auto_resolve", methods=['GET'])
+def auto_resolve():
+    from app.functions import AUTO_RESOLVE_THRESHOLD, auto_resolve_sweep, bump_generations, start_suggestion_fill
+    threshold = request.args.get('threshold', AUTO_RESOLVE_THRESHOLD, type=int)
+    dry_run = request.args.get('dryRun', 'true', type=str).lower() != 'false'
+    if dry_run:
+        report = auto_resolve_sweep(threshold=threshold, dry_run=True)
+    else:
+        # Only a sweep that writes invalidates cached reads, as bumps_generations does for the other write paths
+        try:
+            report = auto_resolve_sweep(threshold=threshold, dry_run=False)
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            bump_generations('matches', 'scrobbles')
+    if report is None:
+        return make_response(jsonify(status='sweep already running'), 409)
+    if not dry_run:
+        start_suggestion_fill()
+    return jsonify(report)
+
+
+@app.route("/api/auto_resolve_progress", methods=['GET'])
+def auto_resolve_progress():
+    from app.functions import sweep_progress
+    return jsonify(sweep_progress)
+
+
 @app.route("/api/csv_upload", methods=['POST'])
+@bumps_generations('matches', 'scrobbles')
 def csv_upload():
-    from app.functions import scrobble_dataframe_to_db, search_match
+    from app.functions import batch_match_unreviewed, import_scrobble_csv, start_suggestion_fill
     csv = request.files['file']
-    df = (pd.read_csv(csv.stream, encoding='utf8')
-          .rename(columns={'uts': 'played_at'})
-          .filter(['played_at', 'artist', 'album', 'track']))
-    df['played_at'] = df['played_at'].map(str)
-    scrobble_dataframe_to_db(df)
-    unreviewed = db.session.query(Scrobble).filter(Scrobble.match_id == sqlalchemy.null()).all()
-    for scrobble in unreviewed:
-        search_match(scrobble)
+    row_count = import_scrobble_csv(csv.stream)
+    matched_count = batch_match_unreviewed()
     db.session.commit()
-    return jsonify_no_content()
+    start_suggestion_fill()
+    return jsonify(matchedCount=matched_count, rowCount=row_count)
+
+
+@app.route("/api/csv_upload_progress", methods=['GET'])
+def csv_upload_progress():
+    from app.functions import csv_progress
+    return jsonify(csv_progress)
 
 
 @app.route("/api/delete_new_track", methods=['POST'])
+@bumps_generations('added_tracks')
 def delete_new_track():
     tracks = request.json
     for track_id in tracks:
@@ -112,18 +208,18 @@ def delete_new_track():
 
 @app.route("/api/get_next_unreviewed", methods=['GET'])
 def get_next_unreviewed():
+    from app.functions import get_suggestions, top_up_suggestions
     schema = ScrobbleSchema()
-    next_unreviewed = db.session.query(Scrobble).filter(Scrobble.match_id == sqlalchemy.null()).first()
-    unreviewed_count = db.session.query(Scrobble).filter(Scrobble.match_id == sqlalchemy.null()).count()
+    unreviewed = db.session.query(Scrobble).join(Scrobble.lastfm_track).filter(LastfmTrack.match_id == sqlalchemy.null())
+    next_unreviewed = unreviewed.order_by(Scrobble.id).first()
+    unreviewed_count = unreviewed.count()
     if next_unreviewed is None:
         return jsonify(status=False)
-    query = select(Plex)
-    df = pd.read_sql(query, con=db.engine)
-    suggestions = process.extract(next_unreviewed.concat_lastfm, df.concat_plex, scorer=fuzz.token_sort_ratio, limit=5)
     suggestions = [
-        {'concatPlex': str(df.at[c, 'concat_plex']), 'id': int(df.at[c, 'id'])}
-        for (a, b, c) in suggestions if b >= 60
+        {'concatPlex': suggestion['concatPlex'], 'id': suggestion['id']}
+        for suggestion in get_suggestions(next_unreviewed.lastfm_track.concat_lastfm)
     ]
+    top_up_suggestions()
     return jsonify(
         scrobble=schema.dump(next_unreviewed),
         status=True,
@@ -133,6 +229,7 @@ def get_next_unreviewed():
 
 
 @app.route("/api/get_scrobble_date_range", methods=['GET'])
+@conditional_get('scrobbles')
 def get_scrobble_date_range():
     first_scrobble = db.session.query(func.min(Scrobble.played_at)).first()
     last_scrobble = db.session.query(func.max(Scrobble.played_at)).first()
@@ -144,72 +241,118 @@ def get_scrobble_date_range():
 
 
 @app.route("/api/handle_delete_matches", methods=['POST'])
+@bumps_generations('matches', 'scrobbles')
 def handle_delete_match():
-    from app.functions import delete_single_plex_play
+    from app.functions import match_scrobbles_filter, reverse_plex_plays, start_suggestion_fill, unlink_matches
     matches = request.json
-    for match_id in matches:
-        match = db.session.query(Match).filter(Match.id == match_id).one()
-        scrobbles = match.scrobbles.all()
-        for scrobble in scrobbles:
-            if scrobble.status == 'processed':
-                delete_single_plex_play(scrobble)
-            scrobble.match_id = None
-            scrobble.status = None
-        db.session.delete(match)
-        db.session.commit()
+    # Every id is checked before Plex is touched, so a stale id cannot leave half-reversed plays behind
+    found = set(match_id for (match_id,) in db.session.query(Match.id).filter(Match.id.in_(matches)))
+    missing = [match_id for match_id in matches if match_id not in found]
+    if len(missing) > 0:
+        return make_response(jsonify(status='unknown matches', missing=missing), 404)
+    reverse_plex_plays(match_scrobbles_filter(matches))
+    unlink_matches(matches)
+    db.session.query(Match).filter(Match.id.in_(matches)).delete(synchronize_session=False)
+    db.session.commit()
+    start_suggestion_fill()
     return jsonify_no_content()
 
 
 @app.route("/api/handle_match", methods=['POST'])
+@bumps_generations('matches', 'scrobbles')
 def handle_match():
+    from app.functions import clear_suggestions, refresh_match_plays
     match = Match(concat_lastfm=request.json['concatLastfm'], plex_id=request.json['plexId'])
     db.session.add(match)
     db.session.flush()
-    scrobbles = db.session.query(Scrobble).filter(Scrobble.concat_lastfm == request.json['concatLastfm']).all()
-    for scrobble in scrobbles:
-        scrobble.match_id = match.id
-        scrobble.status = 'matched'
+    tracks = db.session.query(LastfmTrack).filter(LastfmTrack.concat_lastfm == request.json['concatLastfm']).all()
+    for track in tracks:
+        track.match_id = match.id
+        track.scrobbles.update({Scrobble.status: 'matched'}, synchronize_session=False)
+    refresh_match_plays([match.id])
+    clear_suggestions(request.json['concatLastfm'])
     db.session.commit()
     return jsonify_no_content()
 
 
 @app.route("/api/handle_no_match", methods=['POST'])
+@bumps_generations('matches', 'scrobbles')
 def handle_no_match():
+    from app.functions import clear_suggestions, refresh_match_plays
     match = Match(concat_lastfm=request.json['concatLastfm'], plex_id=0)
     db.session.add(match)
     db.session.flush()
-    scrobbles = db.session.query(Scrobble).filter(Scrobble.concat_lastfm == request.json['concatLastfm']).all()
-    for scrobble in scrobbles:
-        scrobble.match_id = match.id
-        scrobble.status = 'unmatched'
+    tracks = db.session.query(LastfmTrack).filter(LastfmTrack.concat_lastfm == request.json['concatLastfm']).all()
+    for track in tracks:
+        track.match_id = match.id
+        track.scrobbles.update({Scrobble.status: 'unmatched'}, synchronize_session=False)
+    refresh_match_plays([match.id])
+    clear_suggestions(request.json['concatLastfm'])
+    db.session.commit()
+    return jsonify_no_content()
+
+
+@app.route("/api/handle_proposal", methods=['POST'])
+@bumps_generations('matches', 'scrobbles')
+def handle_proposal():
+    from app.functions import match_scrobbles_filter
+    proposal = db.session.query(MatchProposal).filter(MatchProposal.id == request.json['id']).first()
+    if proposal is None:
+        return make_response(jsonify(status='unknown proposal'), 404)
+    if request.json.get('accept'):
+        match = db.session.query(Match).filter(Match.id == proposal.match_id).first()
+        if match is None:
+            return make_response(jsonify(status='unknown match'), 404)
+        # A match resolved since the proposal was made is left alone rather than repointed
+        if match.plex_id != 0:
+            return make_response(jsonify(status='match already resolved'), 409)
+        match.plex_id = proposal.plex_id
+        (db.session.query(Scrobble)
+         .filter(match_scrobbles_filter([match.id]), Scrobble.status == 'unmatched')
+         .update({Scrobble.status: 'matched'}, synchronize_session=False))
+        db.session.query(MatchProposal).filter(MatchProposal.match_id == match.id).delete()
+    else:
+        db.session.delete(proposal)
     db.session.commit()
     return jsonify_no_content()
 
 
 @app.route("/api/home_data", methods=['GET'])
 def home_data():
+    from app.functions import GENERATIONS, generation_cached, match_plays_between
     days = int(request.args.get('days'))
     schema = MatchSchema()
     account = db.session.query(Account).first()
     if account is None:
         return jsonify(status="no account")
-    scrobble_count = db.session.query(Scrobble).count()
-    matched_count = (db.session.query(Scrobble)
-                     .filter(or_(Scrobble.status == 'matched', Scrobble.status == 'processed'))
-                     .count())
-    unreviewed_count = db.session.query(Scrobble).filter(Scrobble.match_id == sqlalchemy.null()).count()
-    plex_count = db.session.query(Plex).count()
-    process_count = db.session.query(Scrobble).filter(Scrobble.status == 'matched').count()
-    new_tracks_count = db.session.query(AddedTrack).count()
-    match_filter = Match.plex_id == 0
+
+    def counts():
+        # Scrobble status counts in one conditional-aggregate pass, the other counts as subqueries of the same
+        # statement; unreviewed scrobbles are reached from the unmatched tracks rather than joined for every row
+        unreviewed = (select(func.count(Scrobble.id))
+                      .join(Scrobble.lastfm_track)
+                      .where(LastfmTrack.match_id == sqlalchemy.null())
+                      .scalar_subquery())
+        return (db.session.query(func.count(Scrobble.id),
+                                 func.count(case((Scrobble.status.in_(['matched', 'processed']), 1))),
+                                 func.count(case((Scrobble.status == 'matched', 1))),
+                                 unreviewed,
+                                 select(func.count(Plex.id)).scalar_subquery(),
+                                 select(func.count(AddedTrack.id)).scalar_subquery())
+                .one())
+
+    # Repeat loads reuse the counts until a write path bumps one of the data generations; the rolling window moves
+    # every second, so the top list is read fresh from the rollup and the edge day's scrobbles
+    (scrobble_count, matched_count, process_count, unreviewed_count, plex_count, new_tracks_count) = (
+        generation_cached(('home_data',), GENERATIONS, lambda: tuple(counts())))
     current_time_minus_days = int(time.time()) - (86400 * days)
-    date_filter = and_(True, Scrobble.played_at >= current_time_minus_days)
-    query_filter = and_(True, match_filter, date_filter)
-    top_recent_unmatched = (db.session.query(Match, func.count(Scrobble.match_id))
-                            .join(Scrobble)
-                            .filter(query_filter)
+    plays = match_plays_between(start=current_time_minus_days)
+    match_filter = Match.plex_id == 0
+    top_recent_unmatched = (db.session.query(Match, func.sum(plays.c.plays))
+                            .join(plays, plays.c.match_id == Match.id)
+                            .filter(match_filter)
                             .group_by(Match)
-                            .order_by(desc(func.count(Scrobble.match_id)))
+                            .order_by(desc(func.sum(plays.c.plays)))
                             .limit(15).all())
     matches = schema.dump([item[0] for item in top_recent_unmatched], many=True)
     for idx, row in enumerate(matches):
@@ -227,7 +370,10 @@ def home_data():
 
 
 @app.route("/api/inspect_matches", methods=['GET'])
+@conditional_get('matches', 'plex_tracks', 'scrobbles')
 def inspect_matches():
+    from app.functions import (cached_match_count, ensure_search_index, match_keyset_page, match_plays_between,
+                               search_index_matches, search_terms)
     schema = MatchSchema()
     start = request.args.get('start')
     end = request.args.get('end')
@@ -236,19 +382,13 @@ def inspect_matches():
     if end:
         end = datetime.fromisoformat(end.replace('"', "").replace("Z", "+00:00")).timestamp()
     active_col = request.args.get('activeCol', type=int)
-    filter_str = request.args.get('filter', '', type=str).split()
-    search_filter = ['%{}%'.format(x) for x in filter_str]
+    fts_query, like_terms = search_terms(request.args.get('filter', '', type=str))
     order_by = request.args.get('order', type=str)
     page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor', type=str)
     show = request.args.get('show', type=str)
 
-    date_filter = True
-    if start and not end:
-        date_filter = and_(True, Scrobble.played_at >= start)
-    elif end and not start:
-        date_filter = and_(True, Scrobble.played_at <= end)
-    elif start and end:
-        date_filter = and_(True, Scrobble.played_at >= start, Scrobble.played_at <= end)
+    plays = match_plays_between(start if start else None, end if end else None)
 
     match_filter = True
     if show == 'matched':
@@ -256,26 +396,48 @@ def inspect_matches():
     if show == 'unmatched':
         match_filter = Match.plex_id == 0
 
-    query_filter = and_(True, *[Match.concat_lastfm.like(x) for x in search_filter], match_filter, date_filter)
+    search_filter = [Match.concat_lastfm.like(x) for x in like_terms]
+    if fts_query:
+        ensure_search_index()
+        search_filter.append(Match.id.in_(select(search_index_matches('matches_fts', fts_query).c.rowid)))
+
+    query_filter = and_(True, *search_filter, match_filter)
+
+    if cursor is not None:
+        # Cursor mode: an empty cursor is the first page, later pages pass back nextCursor/prevCursor
+        try:
+            items, next_cursor, prev_cursor = match_keyset_page(query_filter, plays, active_col, order_by, cursor)
+        except ValueError:
+            return make_response(jsonify(status='invalid cursor'), 400)
+        count_key = (request.args.get('filter', '', type=str), show, start, end)
+        matches = schema.dump([item[0] for item in items], many=True)
+        for idx, row in enumerate(matches):
+            row['playcount'] = items[idx][1]
+        return jsonify(
+            count=cached_match_count(count_key, query_filter, plays),
+            matches=matches,
+            nextCursor=next_cursor,
+            prevCursor=prev_cursor
+        )
 
     if active_col == 0:
-        results = (db.session.query(Match, func.count(Scrobble.match_id))
-                   .join(Scrobble)
+        results = (db.session.query(Match, func.sum(plays.c.plays))
+                   .join(plays, plays.c.match_id == Match.id)
                    .filter(query_filter)
                    .group_by(Match)
                    .paginate(page=page, per_page=20, error_out=False))
 
     if active_col == 1:
         if order_by == 'asc':
-            results = (db.session.query(Match, func.count(Scrobble.match_id))
-                       .join(Scrobble)
+            results = (db.session.query(Match, func.sum(plays.c.plays))
+                       .join(plays, plays.c.match_id == Match.id)
                        .filter(query_filter)
                        .group_by(Match)
                        .order_by(asc(Match.concat_lastfm))
                        .paginate(page=page, per_page=20, error_out=False))
         if order_by == 'desc':
-            results = (db.session.query(Match, func.count(Scrobble.match_id))
-                       .join(Scrobble)
+            results = (db.session.query(Match, func.sum(plays.c.plays))
+                       .join(plays, plays.c.match_id == Match.id)
                        .filter(query_filter)
                        .group_by(Match)
                        .order_by(desc(Match.concat_lastfm))
@@ -283,16 +445,16 @@ def inspect_matches():
 
     if active_col == 2:
         if order_by == 'asc':
-            results = (db.session.query(Match, func.count(Scrobble.match_id))
-                       .join(Scrobble)
+            results = (db.session.query(Match, func.sum(plays.c.plays))
+                       .join(plays, plays.c.match_id == Match.id)
                        .join(Plex, isouter=True)
                        .filter(query_filter)
                        .group_by(Match)
                        .order_by(asc(Plex.concat_plex))
                        .paginate(page=page, per_page=20, error_out=False))
         if order_by == 'desc':
-            results = (db.session.query(Match, func.count(Scrobble.match_id))
-                       .join(Scrobble)
+            results = (db.session.query(Match, func.sum(plays.c.plays))
+                       .join(plays, plays.c.match_id == Match.id)
                        .join(Plex, isouter=True)
                        .filter(query_filter)
                        .group_by(Match)
@@ -301,18 +463,18 @@ def inspect_matches():
 
     if active_col == 3:
         if order_by == 'asc':
-            results = (db.session.query(Match, func.count(Scrobble.match_id))
-                       .join(Scrobble)
+            results = (db.session.query(Match, func.sum(plays.c.plays))
+                       .join(plays, plays.c.match_id == Match.id)
                        .filter(query_filter)
                        .group_by(Match)
-                       .order_by(asc(func.count(Scrobble.match_id)))
+                       .order_by(asc(func.sum(plays.c.plays)))
                        .paginate(page=page, per_page=20, error_out=False))
         if order_by == 'desc':
-            results = (db.session.query(Match, func.count(Scrobble.match_id))
-                       .join(Scrobble)
+            results = (db.session.query(Match, func.sum(plays.c.plays))
+                       .join(plays, plays.c.match_id == Match.id)
                        .filter(query_filter)
                        .group_by(Match)
-                       .order_by(desc(func.count(Scrobble.match_id)))
+                       .order_by(desc(func.sum(plays.c.plays)))
                        .paginate(page=page, per_page=20, error_out=False))
     matches = schema.dump([item[0] for item in results.items], many=True)
     for idx, row in enumerate(matches):
@@ -325,7 +487,29 @@ def inspect_matches():
     )
 
 
+@app.route("/api/match_proposals", methods=['GET'])
+def match_proposals():
+    proposals = (db.session.query(MatchProposal, Match, Plex)
+                 .join(Match, MatchProposal.match_id == Match.id)
+                 .join(Plex, MatchProposal.plex_id == Plex.id)
+                 .filter(Match.plex_id == 0)
+                 .order_by(desc(MatchProposal.score), asc(Match.concat_lastfm))
+                 .all())
+    return jsonify(
+        proposals=[{
+            'id': proposal.id,
+            'matchId': match.id,
+            'concatLastfm': match.concat_lastfm,
+            'plexId': plex.id,
+            'concatPlex': plex.concat_plex,
+            'score': proposal.score
+        } for (proposal, match, plex) in proposals],
+        proposalCount=len(proposals)
+    )
+
+
 @app.route("/api/new_tracks", methods=['GET'])
+@conditional_get('added_tracks', 'plex_tracks')
 def new_tracks():
     new_tracks = db.session.query(AddedTrack, Plex).join(Plex, AddedTrack.rating_key == Plex.rating_key).all()
     new_tracks_count = db.session.query(AddedTrack).count()
@@ -336,20 +520,28 @@ def new_tracks():
 
 
 @app.route("/api/process_matches", methods=['GET'])
+@bumps_generations('accounts', 'scrobbles')
 def process_matches():
     from app.functions import add_scrobbles_to_plex, delete_plex_plays
+    account = db.session.query(Account).first()
+    full = request.args.get('full', 'false', type=str).lower() == 'true'
     delete_plex_plays()
-    add_scrobbles_to_plex()
+    add_scrobbles_to_plex(incremental=not full and account.last_plex_update is not None)
     return jsonify_no_content()
 
 
 @app.route("/api/query", methods=['GET'])
 def query():
+    from app.functions import ensure_search_index, search_index_matches, search_terms
     schema = PlexSchema()
-    search_filter_list = request.args.get('filter').split()
-    search_filter_list = ['%{}%'.format(x) for x in search_filter_list]
-    query_filter = and_(True, *[Plex.concat_plex.like(x) for x in search_filter_list])
-    results = Plex.query.filter(query_filter).limit(30).all()
+    fts_query, like_terms = search_terms(request.args.get('filter'))
+    results = Plex.query.filter(and_(True, *[Plex.concat_plex.like(x) for x in like_terms]))
+    if fts_query:
+        # Best-ranked tracks first; short LIKE terms may reject some of the top 30, so then every hit is kept
+        ensure_search_index()
+        search_matches = search_index_matches('plex_tracks_fts', fts_query, limit=None if like_terms else 30)
+        results = results.join(search_matches, search_matches.c.rowid == Plex.id).order_by(search_matches.c.rank)
+    results = results.limit(30).all()
     return schema.dumps(results, many=True)
 
 
@@ -367,24 +559,35 @@ def sqlite_conflict_rating_key(table, conn, keys, data_iter):
 
 
 @app.route("/api/update_hex_data")
+@bumps_generations('accounts', 'added_tracks', 'matches', 'plex_tracks', 'scrobbles')
 def update_hex_data():
-    from app.functions import get_plex_df, process_unmatch, delete_orphan_match_rows
+    from app.functions import (get_hex_plex_fingerprints, get_plex_df, get_plex_rating_keys, get_plex_watermark,
+                               process_unmatch, delete_orphan_match_rows, plex_index, propose_matches,
+                               invalidate_suggestions, start_suggestion_fill)
+    full = request.args.get('full', 'false', type=str).lower() == 'true'
+    account = db.session.query(Account).first()
     delete_orphan_match_rows()
-    # Get dataframe of all Plex tracks in hex.fm database
-    query = select(Plex)
-    df_before = pd.read_sql(query, con=db.engine).drop(['id'], axis=1)
-    # Get dataframe of all Plex tracks in Plex database
-    df_plex = get_plex_df()
-    # Update Plex tracks in hex.fm database where data is changed
-    df_update = pd.concat([df_before, df_plex]).drop_duplicates(keep=False)
-    df_update = df_update[df_update.duplicated(subset=['rating_key'], keep=False)]
-    df_update = df_update.drop_duplicates(subset=['rating_key'], keep='last')
-    for row in df_update.itertuples():
-        rating_key = getattr(row, 'rating_key')
-        grandparent_guid = getattr(row, 'grandparent_guid')
-        parent_guid = getattr(row, 'parent_guid')
-        guid = getattr(row, 'guid')
-        process_unmatch(rating_key, guids=[grandparent_guid, parent_guid, guid])
+    watermark = get_plex_watermark()
+    ar_old = np.array([rating_key for (rating_key,) in db.session.query(Plex.rating_key)], dtype=np.int64)
+    if full or account.plex_sync_watermark is None:
+        # Get dataframe of all Plex tracks in Plex database, and the fingerprints stored in hex.fm database
+        df_plex = get_plex_df()
+        df_before = get_hex_plex_fingerprints()
+        ar_new = np.array(df_plex['rating_key'].tolist())
+    else:
+        # Only tracks changed since the last sync are read and compared; removals come from the id sets
+        df_plex = get_plex_df(since=account.plex_sync_watermark)
+        df_before = get_hex_plex_fingerprints(df_plex['rating_key'].tolist())
+        ar_new = get_plex_rating_keys()
+    # Update Plex tracks in hex.fm database where the fingerprint has changed
+    df_update = df_plex.merge(df_before, on='rating_key', suffixes=('', '_before'))
+    df_update = df_update[df_update['fingerprint'] != df_update['fingerprint_before']]
+    df_update = df_update.drop(['fingerprint_before'], axis=1)
+    guids = {
+        rating_key: [grandparent_guid, parent_guid, guid] for (rating_key, grandparent_guid, parent_guid, guid)
+        in df_update[['rating_key', 'grandparent_guid', 'parent_guid', 'guid']].itertuples(index=False)
+    }
+    process_unmatch(df_update['rating_key'].tolist(), guids=guids)
     db.session.commit()
     with db.engine.connect() as conn:
         df_update.to_sql(
@@ -395,11 +598,8 @@ def update_hex_data():
             method=sqlite_conflict_rating_key,
             index=False)
     # Delete Plex tracks in hex.fm database that have been removed from the music server
-    ar_old = np.array(df_before['rating_key'].tolist())
-    ar_new = np.array(df_plex['rating_key'].tolist())
     ar_deleted = np.setdiff1d(ar_old, ar_new)
-    for rating_key in ar_deleted:
-        process_unmatch(rating_key, delete_track=True)
+    process_unmatch(ar_deleted.tolist(), delete_tracks=True)
     db.session.commit()
     # Add new Plex tracks to hex.fm database
     ar_added = np.setdiff1d(ar_new, ar_old)
@@ -416,21 +616,26 @@ def update_hex_data():
             if_exists='append',
             method=sqlite_conflict_rating_key,
             index=False)
-    account = db.session.query(Account).first()
+    # Score the new tracks against matches still waiting for a Plex track
+    propose_matches(ar_added.tolist())
     account.last_hex_update = datetime.utcnow()
+    account.plex_sync_watermark = watermark
     db.session.commit()
+    if len(df_update) + len(ar_deleted) + len(ar_added) > 0:
+        plex_index.sync()
+        invalidate_suggestions(df_update['rating_key'].tolist() + ar_added.tolist())
+        db.session.commit()
+        start_suggestion_fill()
     return jsonify_no_content()
 
 
 @app.route("/api/update_lastfm_data")
+@bumps_generations('accounts', 'matches', 'scrobbles')
 def update_lastfm_data():
-    from app.functions import pull_lastfm_data, scrobble_dataframe_to_db, search_match
+    from app.functions import batch_match_unreviewed, ingest_lastfm_data, start_suggestion_fill
     account = db.session.query(Account).first()
-    last_scrobble = db.session.query(func.max(Scrobble.played_at)).first()
-    df = pull_lastfm_data(account.lastfm_username, account.lastfm_api_key, last_scrobble[0])
-    scrobble_dataframe_to_db(df)
-    unreviewed = db.session.query(Scrobble).filter(Scrobble.match_id == sqlalchemy.null()).all()
-    for scrobble in unreviewed:
-        search_match(scrobble)
+    ingest_lastfm_data(account)
+    matched_count = batch_match_unreviewed()
     db.session.commit()
-    return jsonify_no_content()
+    start_suggestion_fill()
+    return jsonify(matchedCount=matched_count)
@@ -0,0 +1,141 @@
+# Compares the previous row-by-row delete_plex_plays against the set-based version on a synthetic library.
+# Run from the api directory: python -m benchmarks.delete_plex_plays [tracks] [views]
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+workdir = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'app.db')
+
+import pandas as pd
+from app import app, db
+from app.functions import delete_plex_plays
+from app.models import Account, Plex
+from sqlalchemy import select
+
+
+def legacy_delete_plex_plays():
+    account = db.session.query(Account).first()
+    query = select(Plex)
+    plex_df = pd.read_sql(query, con=db.engine)[['guid', 'parent_guid', 'grandparent_guid', 'album']]
+    delete_sql = '''DELETE FROM metadata_item_views
+                    WHERE account_id=? AND metadata_type=10 AND device_id!=?'''
+    select_sql = '''SELECT guid, grandparent_guid, parent_title
+                    FROM metadata_item_views
+                    WHERE account_id=? AND metadata_type=10 AND device_id!=?'''
+    update_sql = '''UPDATE metadata_item_settings
+                    SET view_count=view_count-1
+                    WHERE guid=? AND view_count>0 AND account_id=?'''
+    select_all_guids = '''SELECT guid
+                          FROM metadata_items
+                          WHERE metadata_items.metadata_type = 8
+                              OR metadata_items.metadata_type = 9
+                              OR metadata_items.metadata_type = 10'''
+    select_settings_guids = '''SELECT metadata_item_settings.guid, metadata_items.metadata_type
+                               FROM metadata_item_settings
+                               LEFT JOIN metadata_items ON metadata_item_settings.guid = metadata_items.guid
+                               WHERE metadata_item_settings.account_id=?
+                                   AND metadata_items.metadata_type = 8
+                                   OR metadata_items.metadata_type = 9
+                                   OR metadata_items.metadata_type = 10
+                               ORDER BY metadata_items.metadata_type'''
+    delete_settings_row = '''DELETE FROM metadata_item_settings
+                             WHERE account_id=? AND guid=?'''
+    with sqlite3.connect(account.plex_db_file) as conn:
+        c = conn.cursor()
+        li_all_guids = pd.read_sql(select_all_guids, con=conn)['guid'].to_list()
+        li_settings_guids = (pd.read_sql(select_settings_guids, con=conn, params=[account.plex_account_id])['guid']
+                             .to_list())
+        s = set(li_all_guids)
+        diff_guids = [x for x in li_settings_guids if x not in s]
+        for guid in diff_guids:
+            c.execute(delete_settings_row, [account.plex_account_id, guid])
+        df = pd.read_sql(select_sql, con=conn, params=[account.plex_account_id, account.plex_device_id])
+        df = df.merge(
+            plex_df.drop_duplicates(),
+            left_on=['guid', 'grandparent_guid', 'parent_title'],
+            right_on=['guid', 'grandparent_guid', 'album'],
+            how='left')
+        guids = df['guid'].tolist() + df['parent_guid'].tolist() + df['grandparent_guid'].tolist()
+        for guid in guids:
+            c.execute(update_sql, [guid, account.plex_account_id])
+        c.execute(delete_sql, [account.plex_account_id, account.plex_device_id])
+        conn.commit()
+    return
+
+
+def build_plex_db(path, tracks, views):
+    with sqlite3.connect(path) as conn:
+        c = conn.cursor()
+        c.execute('''CREATE TABLE metadata_items (id INTEGER PRIMARY KEY, parent_id INTEGER, metadata_type INTEGER,
+                     guid TEXT, title TEXT, original_title TEXT, "index" INTEGER)''')
+        c.execute('''CREATE TABLE metadata_item_settings (id INTEGER PRIMARY KEY, account_id INTEGER, guid TEXT,
+                     view_count INTEGER, last_viewed_at INTEGER, created_at INTEGER, updated_at INTEGER)''')
+        c.execute('''CREATE INDEX index_metadata_item_settings_on_guid ON metadata_item_settings (guid)''')
+        c.execute('''CREATE TABLE metadata_item_views (id INTEGER PRIMARY KEY, account_id INTEGER, guid TEXT,
+                     metadata_type INTEGER, library_section_id INTEGER, grandparent_title TEXT,
+                     parent_index INTEGER, parent_title TEXT, "index" INTEGER, title TEXT, viewed_at INTEGER,
+                     grandparent_guid TEXT, device_id INTEGER)''')
+        rows = []
+        for i in range(tracks):
+            artist, album = i // 100, i // 10
+            rows.append([i, f'plex://track/{i}', f'plex://album/{album}', f'plex://artist/{artist}',
+                         f'Album {album}'])
+        c.executemany('''INSERT INTO metadata_items (id, metadata_type, guid) VALUES (?, 10, ?)''',
+                      [[row[0], row[1]] for row in rows])
+        settings = set()
+        for row in rows:
+            settings.update(row[1:4])
+        c.executemany('''INSERT INTO metadata_item_settings (account_id, guid, view_count) VALUES (1, ?, 50)''',
+                      [[guid] for guid in sorted(settings)])
+        c.executemany('''INSERT INTO metadata_item_views (account_id, guid, metadata_type, parent_title, viewed_at,
+                         grandparent_guid, device_id) VALUES (1, ?, 10, ?, ?, ?, ?)''',
+                      [[rows[i % tracks][1], rows[i % tracks][4], i, rows[i % tracks][3], 2 if i % 3 else 1]
+                       for i in range(views)])
+        conn.commit()
+    return rows
+
+
+def snapshot(path):
+    with sqlite3.connect(path) as conn:
+        return (conn.execute('SELECT guid, view_count FROM metadata_item_settings ORDER BY guid').fetchall(),
+                conn.execute('SELECT id FROM metadata_item_views ORDER BY id').fetchall())
+
+
+def main(tracks=20000, views=200000):
+    plex_db = os.path.join(workdir, 'plex.db')
+    legacy_db = os.path.join(workdir, 'plex_legacy.db')
+    with app.app_context():
+        db.create_all()
+        rows = build_plex_db(plex_db, tracks, views)
+        shutil.copy(plex_db, legacy_db)
+        db.session.add(Account(plex_account_id=1, plex_db_file=legacy_db, plex_device_id=1))
+        db.session.execute(db.insert(Plex), [
+            {'rating_key': i, 'guid': guid, 'parent_guid': parent_guid, 'grandparent_guid': grandparent_guid,
+             'album': album}
+            for (i, guid, parent_guid, grandparent_guid, album) in rows
+        ])
+        db.session.commit()
+
+        start = time.perf_counter()
+        legacy_delete_plex_plays()
+        legacy_time = time.perf_counter() - start
+
+        db.session.query(Account).first().plex_db_file = plex_db
+        db.session.commit()
+        start = time.perf_counter()
+        delete_plex_plays()
+        new_time = time.perf_counter() - start
+
+    print(f'tracks={tracks} views={views}')
+    print(f'before: {legacy_time:.2f}s')
+    print(f'after:  {new_time:.2f}s')
+    print(f'same end state: {snapshot(legacy_db) == snapshot(plex_db)}')
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
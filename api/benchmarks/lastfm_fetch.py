@@ -0,0 +1,96 @@
+# Times a full-history user.getRecentTracks pull against a local stub of the Last.fm API, comparing the previous
+# sequential fetch loop with the concurrent, rate-limited fetcher. The stub adds latency and answers some
+# requests with 429/503 so the retry path is exercised.
+# Run from the api directory: python -m benchmarks.lastfm_fetch [pages] [latency_ms]
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'app.db')
+
+import requests
+from app import app
+from app.functions import iter_lastfm_pages
+
+PAGES = 50
+LATENCY = 0.2
+attempts = {}
+attempts_lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        page = int(parse_qs(urlparse(self.path).query).get('page', ['1'])[0])
+        time.sleep(LATENCY)
+        with attempts_lock:
+            attempts[page] = attempts.get(page, 0) + 1
+            first_attempt = attempts[page] == 1
+        if first_attempt and page % 10 == 0:
+            self.send_response(429 if page % 20 == 0 else 503)
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+            return
+        body = json.dumps({'recenttracks': {
+            '@attr': {'page': str(page), 'totalPages': str(PAGES)},
+            'track': [{'artist': {'#text': 'Artist'}, 'album': {'#text': 'Album'}, 'name': f'Track {page}-{i}',
+                       'date': {'uts': str(page * 1000 + i)}} for i in range(200)]
+        }}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+def legacy_fetch(url, payload):
+    responses = []
+    page = 1
+    total_pages = 1
+    while page <= total_pages:
+        response = requests.get(url, params=dict(payload, page=page))
+        if response.status_code != 200:
+            # The previous loop halted here; retry so both runs download every page
+            continue
+        total_pages = int(response.json()['recenttracks']['@attr']['totalPages'])
+        responses.append(response)
+        time.sleep(0.25)
+        page += 1
+    return [response.json() for response in responses]
+
+
+def main(pages=PAGES, latency_ms=LATENCY * 1000):
+    global PAGES, LATENCY
+    PAGES, LATENCY = pages, latency_ms / 1000
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/2.0/'
+    app.config['LASTFM_API_URL'] = url
+    payload = {'method': 'user.getRecentTracks', 'limit': 200, 'user': 'stub', 'api_key': 'stub', 'format': 'json'}
+
+    start = time.perf_counter()
+    legacy = legacy_fetch(url, payload)
+    legacy_time = time.perf_counter() - start
+
+    attempts.clear()
+    start = time.perf_counter()
+    results = [result for (_, _, result) in iter_lastfm_pages(payload, 'stub')]
+    new_time = time.perf_counter() - start
+    server.shutdown()
+
+    print(f'pages={pages} latency={latency_ms:.0f}ms')
+    print(f'before: {legacy_time:.2f}s')
+    print(f'after:  {new_time:.2f}s')
+    print(f'same pages: {legacy == results}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])